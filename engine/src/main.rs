@@ -106,6 +106,11 @@ enum Command {
             default_value = "PBNHoneybee"
         )]
         algorithm: honeybee::menu::Algorithm,
+
+        /// Whether or not to keep navigating (in quiet mode), reading the
+        /// JSON output path of each navigation from stdin
+        #[arg(short, long, action)]
+        repeat: bool,
     },
 
     /// Check if a Honeybee problem is solvable
@@ -180,6 +185,7 @@ impl Command {
                 out,
                 json,
                 algorithm,
+                repeat,
             } => main_handler::interact(
                 library,
                 program,
@@ -188,6 +194,7 @@ impl Command {
                 out,
                 custom_parse::at_most_one_path(&json),
                 algorithm,
+                repeat,
             ),
             Self::Check { library, program } => {
                 main_handler::check(library, program)
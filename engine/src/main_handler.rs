@@ -55,18 +55,10 @@ fn load_problem(
     Ok(problem)
 }
 
-/// Use Programming By Navigation interactively
-pub fn interact(
-    library: PathBuf,
-    program: PathBuf,
-    style: menu::CodegenStyle,
-    quiet: bool,
-    out: PathBuf,
-    json: Option<PathBuf>,
-    algorithm: menu::Algorithm,
-) -> Result<(), String> {
+/// Check that a JSON output path can (probably) be written to
+fn check_json_path(json: &Option<PathBuf>) -> Result<(), String> {
     // Quick check to prevent definitely failing to write later
-    if let Some(path) = &json {
+    if let Some(path) = json {
         if path.is_dir() {
             return Err(format!(
                 "{} invalid json path '{}' (path is directory)",
@@ -86,9 +78,102 @@ pub fn interact(
         }
     }
 
+    Ok(())
+}
+
+/// Use Programming By Navigation interactively
+pub fn interact(
+    library: PathBuf,
+    program: PathBuf,
+    style: menu::CodegenStyle,
+    quiet: bool,
+    out: PathBuf,
+    json: Option<PathBuf>,
+    algorithm: menu::Algorithm,
+    repeat: bool,
+) -> Result<(), String> {
+    if repeat {
+        return interact_repeatedly(
+            library, program, style, quiet, out, algorithm,
+        );
+    }
+
+    check_json_path(&json)?;
+
+    let problem = load_problem(library, program)?;
+    let gen = style.codegen(problem.library.clone())?;
+
+    navigate(problem, gen.as_ref(), quiet, out, json, &algorithm)?;
+    Ok(())
+}
+
+/// Use Programming By Navigation many times on the same problem (e.g., from
+/// scripts), loading it only once
+///
+/// Each navigation starts by reading the path to write its JSON output to
+/// from stdin, and ends by printing "done: " followed by that path (or "not
+/// possible: " followed by that path if no solution was reached, in which
+/// case nothing is written there). Input ends at the end of stdin (or an
+/// empty line).
+fn interact_repeatedly(
+    library: PathBuf,
+    program: PathBuf,
+    style: menu::CodegenStyle,
+    quiet: bool,
+    out: PathBuf,
+    algorithm: menu::Algorithm,
+) -> Result<(), String> {
+    if !quiet {
+        return Err(format!(
+            "{} repeated navigation requires quiet mode",
+            Red.bold().paint("error:"),
+        ));
+    }
+
     let problem = load_problem(library, program)?;
     let gen = style.codegen(problem.library.clone())?;
 
+    loop {
+        let mut input = String::new();
+        std::io::stdin()
+            .read_line(&mut input)
+            .map_err(|e| e.to_string())?;
+        let input = input.trim();
+
+        if input.is_empty() {
+            return Ok(());
+        }
+
+        let json = Some(PathBuf::from(input));
+        check_json_path(&json)?;
+
+        let solved = navigate(
+            problem.clone(),
+            gen.as_ref(),
+            quiet,
+            out.clone(),
+            json,
+            &algorithm,
+        )?;
+
+        if solved {
+            println!("done: {}", input);
+        } else {
+            println!("not possible: {}", input);
+        }
+    }
+}
+
+/// Navigate to a single solution of a problem, returning whether one was
+/// reached (rather than the navigation being impossible or quit)
+fn navigate(
+    problem: core::Problem,
+    gen: &dyn Codegen,
+    quiet: bool,
+    out: PathBuf,
+    json: Option<PathBuf>,
+    algorithm: &menu::Algorithm,
+) -> Result<bool, String> {
     let timer = util::Timer::infinite();
     let mut controller = algorithm.controller(timer, problem, false);
 
@@ -102,7 +187,7 @@ pub fn interact(
             if !quiet {
                 println!("{}", Red.bold().paint("Not possible!"));
             }
-            return Ok(());
+            return Ok(false);
         }
 
         if !quiet {
@@ -159,7 +244,7 @@ pub fn interact(
             let input = input.trim();
 
             if input == "q" {
-                return Ok(());
+                return Ok(false);
             }
 
             match input.parse::<usize>() {
@@ -202,7 +287,7 @@ pub fn interact(
         };
     }
 
-    Ok(())
+    Ok(true)
 }
 
 /// Check if a Honeybee problem is solvable
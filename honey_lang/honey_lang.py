@@ -1,10 +1,27 @@
+import argparse
 import ast
+import asyncio
+import atexit
+import codecs
+import concurrent.futures
+import contextlib
+import contextvars
 import datetime
+import hashlib
+import importlib.util
 import inspect
+import json
+import linecache
 import os
 import re
+import runpy
+import shutil
+import signal
 import subprocess
-from dataclasses import dataclass
+import sys
+import threading
+import time
+from dataclasses import asdict, dataclass, field
 
 
 def deindent(s):
@@ -16,39 +33,13 @@ def deindent(s):
     return ret
 
 
-# Based on https://stackoverflow.com/a/77628177
-def _attribute_info(cls):
-    src = deindent(inspect.getsource(cls))
-    tree = ast.parse(src.strip())
-    for t in ast.walk(tree):
-        if isinstance(t, ast.ClassDef):
-            class_def = t
-            break
-    else:
-        return None
-
-    types = {}
-    docs = {}
-    last_attribute = None
-    for expr in class_def.body:
-        if isinstance(expr, ast.AnnAssign):
-            last_attribute = ast.unparse(expr.target)
-            types[last_attribute] = ast.unparse(expr.annotation)
-        elif isinstance(expr, ast.Expr) and last_attribute is not None:
-            value = expr.value.value
-            if isinstance(value, str):
-                docs[last_attribute] = value.strip()
-
-    return types, docs
-
-
 def _python_to_honeybee(type_name: str) -> str:
     if type_name == "str":
-        return '"Str"'
+        return "Str"
     elif type_name == "int":
-        return '"Int"'
+        return "Int"
     elif type_name == "bool":
-        return '"Bool"'
+        return "Bool"
     else:
         raise ValueError("Unable to convert to Honeybee type: " + type_name)
 
@@ -86,15 +77,318 @@ def _parse_title_description_example(s: str) -> tuple[str, str | None, str | Non
         return s, None, None
 
 
-def _emit_met_sig(kind, cls):
-    assert kind in {"InputProp", "InputType", "OutputType"}
+@dataclass
+class ClassInfo:
+    source: str
+    doc: str | None
+    types: dict[str, str]
+    docs: dict[str, str]
 
-    if kind == "InputProp":
-        print(f"[Prop.P_{cls.__name__}]")
+
+@dataclass
+class FunctionInfo:
+    source: str
+    doc: str | None
+    code: str
+    hyper_parameters: list[Parameter]
+
+
+def _is_docstring(node):
+    return (
+        isinstance(node, ast.Expr)
+        and isinstance(node.value, ast.Constant)
+        and isinstance(node.value.value, str)
+    )
+
+
+class SourceIndex:
+    """Index of the classes and functions in a library source file
+
+    The file is parsed exactly once; the decorators look up the source,
+    docstrings, attributes, and hyperparameters of their definitions here (by
+    qualified name) instead of re-reading and re-parsing source for each."""
+
+    def __init__(self, source: str):
+        self.lines = source.splitlines()
+        self.imports: list[str] = []
+        self.classes: dict[str, ClassInfo] = {}
+        self.functions: dict[str, FunctionInfo] = {}
+
+        tree = ast.parse(source)
+
+        for node in tree.body:
+            if not isinstance(node, (ast.Import, ast.ImportFrom)):
+                break
+            if isinstance(node, ast.ImportFrom) and node.module == "honey_lang":
+                continue
+            self.imports.append(self._segment(node.lineno, node.end_lineno))
+
+        self._index(tree.body, "")
+
+    def _segment(self, start, end) -> str:
+        return "\n".join(self.lines[start - 1 : end])
+
+    def _source(self, node) -> str:
+        start = node.lineno
+        if node.decorator_list:
+            start = node.decorator_list[0].lineno
+        return self._segment(start, node.end_lineno)
+
+    def _index(self, nodes, prefix):
+        for node in nodes:
+            if isinstance(node, ast.ClassDef):
+                self.classes[prefix + node.name] = self._class_info(node)
+                self._index(node.body, prefix + node.name + ".")
+            elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                self.functions[prefix + node.name] = self._function_info(node)
+                self._index(node.body, prefix + node.name + ".<locals>.")
+            elif isinstance(node, (ast.stmt, ast.excepthandler)):
+                self._index(ast.iter_child_nodes(node), prefix)
+
+    # Based on https://stackoverflow.com/a/77628177
+    def _class_info(self, node: ast.ClassDef) -> ClassInfo:
+        types = {}
+        docs = {}
+        last_attribute = None
+        for expr in node.body:
+            if isinstance(expr, ast.AnnAssign):
+                last_attribute = ast.unparse(expr.target)
+                types[last_attribute] = ast.unparse(expr.annotation)
+            elif _is_docstring(expr) and last_attribute is not None:
+                docs[last_attribute] = expr.value.value.strip()
+
+        return ClassInfo(
+            source=self._source(node),
+            doc=ast.get_docstring(node),
+            types=types,
+            docs=docs,
+        )
+
+    def _function_info(self, node) -> FunctionInfo:
+        body = node.body
+        if _is_docstring(body[0]):
+            start = body[0].end_lineno + 1
+        else:
+            # Include comments (e.g. hyperparameters) above the first statement
+            start = body[0].lineno
+            while start - 1 > node.lineno and (
+                self.lines[start - 2].strip() == ""
+                or self.lines[start - 2].strip().startswith("#")
+            ):
+                start -= 1
+
+        indent = body[0].col_offset
+        lines = self.lines[start - 1 : node.end_lineno]
+
+        code = ""
+        hyper_parameters = []
+        i = 0
+        while i < len(lines):
+            line = lines[i]
+            if line.strip().startswith("# PARAMETER:") and i + 1 < len(lines):
+                hyper_parameters.append(_parse_parameter(line, lines[i + 1]))
+                i += 2
+                continue
+            code += line[indent:] + "\n"
+            i += 1
+
+        return FunctionInfo(
+            source=self._source(node),
+            doc=ast.get_docstring(node),
+            code=code.strip(),
+            hyper_parameters=hyper_parameters,
+        )
+
+
+# Source indexes by filename (along with the modification time they were
+# built for)
+_indexes: dict[str, tuple[int, SourceIndex]] = {}
+
+
+def source_index(obj) -> SourceIndex:
+    filename = inspect.getsourcefile(obj)
+    if filename is None:
+        raise ValueError("Unknown object file for " + str(obj))
+
+    mtime = os.stat(filename).st_mtime_ns
+    if filename in _indexes and _indexes[filename][0] == mtime:
+        return _indexes[filename][1]
+
+    index = SourceIndex("".join(linecache.getlines(filename)))
+    _indexes[filename] = (mtime, index)
+    return index
+
+
+def _class_info(cls) -> ClassInfo:
+    try:
+        return source_index(cls).classes[cls.__qualname__]
+    except KeyError:
+        raise ValueError(f"Unable to find source for class '{cls.__qualname__}'")
+
+
+def _function_info(f) -> FunctionInfo:
+    try:
+        return source_index(f).functions[f.__qualname__]
+    except KeyError:
+        raise ValueError(f"Unable to find source for function '{f.__qualname__}'")
+
+
+def _multiline(s: str) -> str:
+    # Descriptions and code have always been emitted as multi-line TOML
+    # strings, which drop a newline right after the opening delimiter
+    return s[1:] if s.startswith("\n") else s
+
+
+def _toml_key(k: str) -> str:
+    if re.fullmatch(r"[A-Za-z0-9_-]+", k):
+        return k
+    return json.dumps(k)
+
+
+def _toml_string(s: str) -> str:
+    if "\n" in s and "'''" not in s and not re.search(r"[\x00-\x08\x0b-\x1f\x7f]", s):
+        # TOML drops a newline right after the opening delimiter
+        if s.startswith("\n"):
+            s = "\n" + s
+        return "'''" + s + "'''"
+    return json.dumps(s, ensure_ascii=False).replace("\x7f", "\\u007f")
+
+
+def _toml_value(v) -> str:
+    if isinstance(v, bool):
+        return "true" if v else "false"
+    elif isinstance(v, int):
+        return str(v)
+    elif isinstance(v, str):
+        return _toml_string(v)
+    elif isinstance(v, dict):
+        if len(v) == 0:
+            return "{}"
+        entries = ", ".join(f"{_toml_key(k)} = {_toml_value(x)}" for k, x in v.items())
+        return "{ " + entries + " }"
+    elif isinstance(v, list):
+        if len(v) == 0:
+            return "[]"
+        return "[\n" + "".join(f"    {_toml_value(x)},\n" for x in v) + "]"
     else:
-        print(f"[Type.{cls.__name__}]")
+        raise ValueError(f"Unable to convert to TOML: {v!r}")
+
+
+def _toml_entries(prefix: str, d: dict):
+    for k, v in d.items():
+        key = prefix + _toml_key(k)
+        if isinstance(v, dict) and len(v) > 0:
+            yield from _toml_entries(key + ".", v)
+        else:
+            yield f"{key} = {_toml_value(v)}"
+
+
+@dataclass
+class Record:
+    """A single Type, Prop, Function, or Preamble of a Honeybee library"""
+
+    section: str
+    name: str | None
+    body: dict
+
+    def to_toml(self) -> str:
+        if self.section == "Preamble":
+            header = "[[Preamble]]"
+        else:
+            header = f"[{self.section}.{_toml_key(self.name)}]"
+        return "\n".join([header, *_toml_entries("", self.body)]) + "\n"
+
+
+class LibraryBuilder:
+    """Collects the records of a Honeybee library in memory
+
+    While a builder is active (used as a context manager), the Input, Output,
+    Function, and Helper decorators add their records to it rather than
+    printing TOML to stdout. The whole library can then be serialized at once
+    with to_toml(), to_json(), or write()."""
+
+    def __init__(self, *, echo=False):
+        self.records: list[Record] = []
+        self.echo = echo
+        self.has_imports = False
+        self._previous = None
+
+    def add(self, records: list[Record]):
+        self.records.extend(records)
+        if self.echo:
+            sys.stdout.write("".join(r.to_toml() + "\n" for r in records))
+
+    def _section(self, section: str) -> dict[str, dict]:
+        return {r.name: r.body for r in self.records if r.section == section}
+
+    @property
+    def types(self) -> dict[str, dict]:
+        return self._section("Type")
+
+    @property
+    def props(self) -> dict[str, dict]:
+        return self._section("Prop")
+
+    @property
+    def functions(self) -> dict[str, dict]:
+        return self._section("Function")
+
+    @property
+    def preambles(self) -> list[dict]:
+        return [r.body for r in self.records if r.section == "Preamble"]
+
+    def to_dict(self) -> dict:
+        library = {}
+        for r in self.records:
+            if r.section == "Preamble":
+                library.setdefault("Preamble", []).append(r.body)
+            else:
+                library.setdefault(r.section, {})[r.name] = r.body
+        return library
+
+    def to_toml(self) -> str:
+        return "\n".join(r.to_toml() for r in self.records)
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=2, ensure_ascii=False) + "\n"
 
-    types, docs = _attribute_info(cls)
+    def write(self, path, format=None):
+        if format is None:
+            format = "json" if str(path).endswith(".json") else "toml"
+
+        if format == "toml":
+            contents = self.to_toml()
+        elif format == "json":
+            contents = self.to_json()
+        else:
+            raise ValueError(f"Unknown library format '{format}'")
+
+        with open(path, "w") as f:
+            f.write(contents)
+
+    def __enter__(self):
+        global _builder
+        self._previous = _builder
+        _builder = self
+        return self
+
+    def __exit__(self, *exc_info):
+        global _builder
+        _builder = self._previous
+        self._previous = None
+
+
+# Without an active LibraryBuilder, records are printed as soon as they are
+# made (so that `python LIBRARY.py > LIBRARY.hblib.toml` works)
+_builder = LibraryBuilder(echo=True)
+
+
+def _met_records(kind, cls) -> list[Record]:
+    assert kind in {"InputProp", "InputType", "OutputType"}
+
+    class_info = _class_info(cls)
+    types = class_info.types.copy()
+    docs = class_info.docs
 
     if kind == "OutputType":
         if "path" not in types:
@@ -105,58 +399,60 @@ def _emit_met_sig(kind, cls):
                 f"Attribute 'path' must be of type str in Output '{cls.__name__}'"
             )
 
-    if len(types) == 0:
-        print("params = {}")
-
-    for p in types:
-        hb_type = _python_to_honeybee(types[p])
-        print(f"params.{p} = {hb_type}")
+    body = {"params": {p: _python_to_honeybee(types[p]) for p in types}}
+    info = {}
 
     title = None
     description = None
 
-    if cls.__doc__ is not None:
-        title, description, _ = _parse_title_description_example(cls.__doc__)
+    if class_info.doc is not None:
+        title, description, _ = _parse_title_description_example(class_info.doc)
 
     if title is not None:
-        print(f'info.title = "{title}"')
+        info["title"] = title
 
     if description is not None:
-        print(f'info.description = """{description}"""')
+        info["description"] = _multiline(description)
 
     for p in docs:
         p_title, p_description, p_example = _parse_title_description_example(docs[p])
-        print(f'info.param_titles.{p} = "{p_title}"')
+        info.setdefault("param_titles", {})[p] = p_title
         if p_description is not None:
-            print(f'info.param_descriptions.{p} = """{p_description}"""')
+            info.setdefault("param_descriptions", {})[p] = _multiline(p_description)
         if p_example is not None:
-            print(f'info.param_examples.{p} = """{p_example}"""')
+            info.setdefault("param_examples", {})[p] = p_example
 
     if kind == "InputProp":
-        print()
-        print(f"[Function.F_{cls.__name__}]")
-        print("params = {}")
-        print(f'ret = "{cls.__name__}"')
-        print("condition = [")
+        if len(info) > 0:
+            body["info"] = info
+
         arg_string = ", ".join(f"{p} = ret.{p}" for p in types)
-        print(f'    "P_{cls.__name__} {{ {arg_string} }}"')
-        print("]")
+        function_body = {
+            "params": {},
+            "ret": cls.__name__,
+            "condition": [f"P_{cls.__name__} {{ {arg_string} }}"],
+        }
         if title is not None:
-            print(f'info.title = "{title}"')
-    else:
-        code = ""
-        for line in inspect.getsource(cls).splitlines():
-            if line.startswith("@Input") or line.startswith("@Output"):
-                line = "@dataclass"
-            code += line + "\n"
-        print(f"info.code = '''{code.strip()}'''")
+            function_body["info"] = {"title": title}
+
+        return [
+            Record("Prop", f"P_{cls.__name__}", body),
+            Record("Function", f"F_{cls.__name__}", function_body),
+        ]
 
-    print()
+    code = ""
+    for line in class_info.source.splitlines():
+        if line.startswith("@Input") or line.startswith("@Output"):
+            line = "@dataclass"
+        code += line + "\n"
+    info["code"] = code.strip()
 
+    body["info"] = info
 
-def _emit_function_sig(f, condition, kwargs):
-    print(f"[Function.{f.__name__}]")
+    return [Record("Type", cls.__name__, body)]
 
+
+def _function_records(f, condition, kwargs) -> list[Record]:
     params = f.__annotations__.copy()
 
     if "return" in params:
@@ -167,8 +463,7 @@ def _emit_function_sig(f, condition, kwargs):
     if len(params) == 0 or list(params)[-1] != "__hb_ret":
         raise ValueError(f"Need '__hb_ret' as final param in function '{f.__name__}'")
 
-    if len(params) == 1:
-        print("params = {}")
+    body = {"params": {}}
 
     for p in params:
         cls = params[p]
@@ -186,24 +481,24 @@ def _emit_function_sig(f, condition, kwargs):
             )
 
         if p == "ret":
-            print(f'ret = "{cls.__name__}"')
+            body["ret"] = cls.__name__
         else:
-            print(f'params.{p} = "{cls.__name__}"')
+            body["params"][p] = cls.__name__
+
+    body["condition"] = list(condition)
+
+    info = {}
 
-    print("condition = [")
-    for c in condition:
-        c = c.replace('"', '\\"')
-        print(f'    "{c}",')
-    print("]")
+    function_info = _function_info(f)
 
-    if f.__doc__ is not None:
-        title, description, _ = _parse_title_description_example(f.__doc__)
+    if function_info.doc is not None:
+        title, description, _ = _parse_title_description_example(function_info.doc)
         if description is None:
             # "title" becomes "description"
-            print(f'info.description = "{title}"')
+            info["description"] = title
         else:
-            print(f'info.title = "{title}"')
-            print(f'info.description = """{description}"""')
+            info["title"] = title
+            info["description"] = _multiline(description)
 
     for k in kwargs:
         if k in {"title", "description"}:
@@ -211,120 +506,984 @@ def _emit_function_sig(f, condition, kwargs):
                 f"Cannot use reserved keyword '{k}' in function '{f.__name__}'"
             )
         if isinstance(kwargs[k], list):
-            rhs = "[" + ", ".join('"' + entry + '"' for entry in kwargs[k]) + "]"
-            print(f"info.{k} = {rhs}")
+            info[k] = [str(entry) for entry in kwargs[k]]
         else:
-            print(f'info.{k} = "{kwargs[k]}"')
+            info[k] = str(kwargs[k])
 
-    code = ""
-    found_def = False
-    initial_indent = None
+    info["hyperparameters"] = [
+        {"name": param.name, "default": param.default, "comment": param.comment}
+        for param in function_info.hyper_parameters
+    ]
+
+    info["code"] = _multiline(function_info.code)
+
+    body["info"] = info
+
+    return [Record("Function", f.__name__, body)]
+
+
+class FragmentCache:
+    """Persistent cache of emitted library fragments
+
+    Each fragment is keyed by a hash of the source of the definition that
+    produced it (along with the source of honey_lang itself), so editing one
+    class or function only invalidates the fragments for that definition."""
 
-    hyper_parameters = {}
-    it = iter(inspect.getsource(f).splitlines())
-    while True:
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, *parts):
+        h = hashlib.sha256(_honey_lang_hash().encode())
+        for part in parts:
+            h.update(b"\0")
+            h.update(part.encode())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".json")
+
+    def get(self, key):
         try:
-            line = next(it)
+            with open(self._path(key), "r") as f:
+                fragment = json.load(f)["fragment"]
+        except (OSError, ValueError, KeyError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return fragment
 
-            if line.startswith("def"):
-                found_def = True
-                continue
+    def put(self, key, fragment):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write-then-rename so concurrent compilers never see partial entries
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"fragment": fragment}, f)
+        os.replace(tmp, path)
 
-            if not found_def:
-                continue
+    def report(self):
+        return f"honey_lang cache: {self.hits} hits, {self.misses} misses"
 
-            if initial_indent is None:
-                initial_indent = len(line) - len(line.lstrip())
 
-            if line.strip().startswith("# PARAMETER:"):
-                param = _parse_parameter(line, next(it))
-                hyper_parameters[param.name] = param
-                continue
+_cache = None
+_self_hash = None
 
-            code += line[initial_indent:] + "\n"
-        except StopIteration:
-            break
 
-    print("info.hyperparameters = [")
-    for param in hyper_parameters.values():
-        print(
-            f"    {{name = '{param.name}', default = '{param.default}', comment = '{param.comment}' }},"
-        )
-    print("]")
+def _honey_lang_hash():
+    global _self_hash
+    if _self_hash is None:
+        with open(__file__, "rb") as f:
+            _self_hash = hashlib.sha256(f.read()).hexdigest()
+    return _self_hash
+
+
+def _report_cache():
+    if _cache.hits + _cache.misses > 0:
+        print(_cache.report(), file=sys.stderr)
+
+
+def enable_cache(directory):
+    global _cache
+    if _cache is None:
+        atexit.register(_report_cache)
+    _cache = FragmentCache(directory)
+    return _cache
+
+
+if os.environ.get("HONEY_LANG_CACHE"):
+    enable_cache(os.environ["HONEY_LANG_CACHE"])
+
 
-    code = re.sub(
-        pattern='"""(.|\n)*?"""\\s*',
-        repl="",
-        string=code,
-        count=1,
-    ).strip()
+def _records_cached(key_parts, make_records, *args) -> list[Record]:
+    if _cache is None:
+        return make_records(*args)
 
-    print(f"info.code = '''{code}'''")
-    print()
+    key = _cache.key(*key_parts)
+    fragment = _cache.get(key)
+    if fragment is None:
+        records = make_records(*args)
+        _cache.put(key, [asdict(r) for r in records])
+        return records
+
+    return [Record(**r) for r in fragment]
+
+
+def _met_key(kind, cls):
+    return [kind, cls.__qualname__, _class_info(cls).source]
+
+
+def _function_key(f, condition, kwargs):
+    # Parameter types are only checked (not emitted) by _function_records, so
+    # their Honeybee-ness needs to be part of the key
+    annotations = [
+        f"{p}: {getattr(cls, '__name__', cls)} {hasattr(cls, '__honeybee_type')}"
+        for p, cls in f.__annotations__.items()
+    ]
+    return [
+        "Function",
+        f.__qualname__,
+        _function_info(f).source,
+        repr(condition),
+        repr(kwargs),
+        *annotations,
+    ]
+
+
+def _helper_records(obj, builder) -> list[Record]:
+    records = []
+
+    index = source_index(obj)
+    if not builder.has_imports:
+        imports = index.imports.copy()
+        for needed_import in ["from dataclasses import dataclass", "import os"]:
+            if needed_import not in imports:
+                imports.append(needed_import)
+        imports.sort()
+        records.append(Record("Preamble", None, {"content": "\n".join(imports)}))
+
+        builder.has_imports = True
+
+    if inspect.isclass(obj):
+        source = _class_info(obj).source
+    else:
+        source = _function_info(obj).source
+
+    # Drop the @Helper decorator
+    code = "\n".join(source.splitlines()[1:])
+    records.append(Record("Preamble", None, {"content": code.strip()}))
+
+    return records
+
+
+@dataclass
+class Definition:
+    """A decorated class or function, compiled into records on demand"""
+
+    kind: str
+    obj: object
+    condition: tuple = ()
+    kwargs: dict = field(default_factory=dict)
+
+    def compile(self, builder: LibraryBuilder):
+        if self.kind == "Input":
+            cls = self.obj
+            records = _records_cached(
+                _met_key("InputType", cls), _met_records, "InputType", cls
+            ) + _records_cached(
+                _met_key("InputProp", cls), _met_records, "InputProp", cls
+            )
+        elif self.kind == "Output":
+            cls = self.obj
+            records = _records_cached(
+                _met_key("OutputType", cls), _met_records, "OutputType", cls
+            )
+        elif self.kind == "Function":
+            records = _records_cached(
+                _function_key(self.obj, self.condition, self.kwargs),
+                _function_records,
+                self.obj,
+                self.condition,
+                self.kwargs,
+            )
+        elif self.kind == "Helper":
+            records = _helper_records(self.obj, builder)
+        else:
+            raise ValueError(f"Unknown definition kind '{self.kind}'")
+
+        builder.add(records)
+
+
+# Definitions by module name, in definition order
+_definitions: dict[str, list[Definition]] = {}
+
+# In runtime mode, the decorators only register definitions; nothing is
+# compiled until a library is exported
+_runtime = os.environ.get("HONEY_LANG_MODE") == "runtime"
+
+
+@contextlib.contextmanager
+def runtime_mode(enabled=True):
+    global _runtime
+    previous = _runtime
+    _runtime = enabled
+    try:
+        yield
+    finally:
+        _runtime = previous
+
+
+def _register(definition: Definition):
+    _definitions.setdefault(definition.obj.__module__, []).append(definition)
+    if not _runtime:
+        definition.compile(_builder)
+
+
+def definitions(module) -> list[Definition]:
+    return _definitions.get(module.__name__, [])
+
+
+def export(module) -> LibraryBuilder:
+    """Compile the definitions of a library module (e.g. one loaded in runtime
+    mode) into a new LibraryBuilder"""
+    lib = LibraryBuilder()
+    for definition in definitions(module):
+        definition.compile(lib)
+    return lib
+
+
+def load_library(path):
+    """Import a library module in runtime mode (for running its functions)"""
+    name = os.path.splitext(os.path.basename(path))[0].replace("-", "_")
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    with runtime_mode():
+        spec.loader.exec_module(module)
+    return module
+
+
+# Input and output types are dataclasses (as in generated code) so that
+# library functions can also be run directly (see run_expression)
 
 
 def Input(cls):
-    _emit_met_sig("InputType", cls)
-    _emit_met_sig("InputProp", cls)
     cls.__honeybee_type = True
-    return cls
+    _register(Definition("Input", cls))
+    return dataclass(cls)
 
 
 def Output(cls):
-    _emit_met_sig("OutputType", cls)
     cls.__honeybee_type = True
-    return cls
+    _register(Definition("Output", cls))
+    return dataclass(cls)
 
 
 def Function(*condition, **kwargs):
     def wrap(f):
-        _emit_function_sig(f, condition, kwargs)
+        _register(Definition("Function", f, condition, kwargs))
         return f
 
     return wrap
 
 
-helper_ran = False
+def Helper(obj):
+    _register(Definition("Helper", obj))
+    return obj
+
+
+@dataclass
+class BashOptions:
+    """How __hb_bash runs the commands of a step (see run_bash)"""
 
+    log_dir: str
+    timeout: float | None = None
+    ledger: str | None = None
 
-def Helper(obj):
-    global helper_ran
-    obj_file = inspect.getsourcefile(obj)
-    if obj_file is None:
-        raise ValueError("Unknown object file for " + str(obj))
-    if obj_file != __file__ and not helper_ran:
-        imports = []
-        with open(obj_file, "r") as f:
-            for line in f:
-                line = line.strip()
-                if line.startswith("import") or line.startswith("from"):
-                    imports.append(line)
-                else:
-                    break
-        for needed_import in ["from dataclasses import dataclass", "import os"]:
-            if needed_import not in imports:
-                imports.append(needed_import)
-        imports.sort()
-        print(f"[[Preamble]]\ncontent = '''{'\n'.join(imports)}'''\n")
 
-        helper_ran = True
+@dataclass
+class BashResult:
+    command: str
+    log: str
+    start: str
+    returncode: int | None
+    timed_out: bool
+    wall: float
+    user: float | None
+    sys: float | None
+    max_rss_kb: int | None
+
+
+# The bash options and log name of the step running in the current thread
+_bash_step: contextvars.ContextVar[tuple[BashOptions, str] | None] = (
+    contextvars.ContextVar("_bash_step", default=None)
+)
+
+_ledger_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def bash_step(options: BashOptions, name: str):
+    """Run the __hb_bash commands in this block with run_bash, logging to
+    options.log_dir/name.log"""
+    token = _bash_step.set((options, name))
+    try:
+        yield
+    finally:
+        _bash_step.reset(token)
+
+
+def in_bash_step() -> bool:
+    """Whether the current thread is running a step with BashOptions (see
+    bash_step)"""
+    return _bash_step.get() is not None
+
+
+# Runs a shell command, then reports the resource usage of everything it ran
+# (which a parent cannot get for one child among many) to the given fd
+_RUSAGE_WRAPPER = """
+import json, os, resource, subprocess, sys
+returncode = subprocess.call(sys.argv[1], shell=True)
+usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+with os.fdopen(int(sys.argv[2]), "w") as f:
+    json.dump([usage.ru_utime, usage.ru_stime, usage.ru_maxrss], f)
+sys.exit(returncode if returncode >= 0 else 128 - returncode)
+"""
+
+
+async def run_bash(command, *, log, timeout=None, echo=True) -> BashResult:
+    """Run a bash command, streaming its output (stdout and stderr) to the
+    file log (and, if echo, to stdout) as it is produced
+
+    The command is killed (along with everything it started) if it runs for
+    longer than timeout seconds. Returns the exit code, wall time, CPU time,
+    and peak memory usage of the command."""
+
+    start = datetime.datetime.now().isoformat()
+    start_time = time.perf_counter()
+
+    usage_read, usage_write = os.pipe()
+    try:
+        process = await asyncio.create_subprocess_exec(
+            sys.executable,
+            "-c",
+            _RUSAGE_WRAPPER,
+            command,
+            str(usage_write),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            pass_fds=(usage_write,),
+            start_new_session=True,
+        )
+    finally:
+        os.close(usage_write)
+
+    async def stream():
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        with open(log, "ab") as f:
+            f.write(f"$ {command.strip()}\n".encode())
+            while chunk := await process.stdout.read(1 << 16):
+                f.write(chunk)
+                if echo:
+                    sys.stdout.write(decoder.decode(chunk))
+                    sys.stdout.flush()
+
+    timed_out = False
+    try:
+        await asyncio.wait_for(asyncio.gather(stream(), process.wait()), timeout)
+    except TimeoutError:
+        timed_out = True
+        for sig in [signal.SIGTERM, signal.SIGKILL]:
+            try:
+                os.killpg(process.pid, sig)
+                await asyncio.wait_for(process.wait(), 5)
+                break
+            except ProcessLookupError:
+                break
+            except TimeoutError:
+                continue
 
-    code = ""
-    for line in inspect.getsource(obj).splitlines()[1:]:
-        code += line + "\n"
-    print(f"[[Preamble]]\ncontent='''{code.strip()}'''\n")
+    wall = time.perf_counter() - start_time
+
+    with os.fdopen(usage_read, "r") as f:
+        usage = f.read()
+    user, sys_time, max_rss = json.loads(usage) if usage else (None, None, None)
+    if max_rss is not None and sys.platform == "darwin":
+        max_rss //= 1024  # bytes on macOS, kilobytes elsewhere
+
+    return BashResult(
+        command=command,
+        log=log,
+        start=start,
+        returncode=None if timed_out else process.returncode,
+        timed_out=timed_out,
+        wall=wall,
+        user=user,
+        sys=sys_time,
+        max_rss_kb=max_rss,
+    )
 
-    return obj
+
+def _record(ledger, step, result: BashResult):
+    line = json.dumps({"step": step, **asdict(result)})
+    with _ledger_lock, open(ledger, "a") as f:
+        f.write(line + "\n")
 
 
 def __hb_bash(command):
     print(f"Running bash command:\n\n{command}\n")
 
-    p = subprocess.run(
-        command,
-        shell=True,
-        text=True,
+    current = _bash_step.get()
+    if current is None:
+        p = subprocess.run(
+            command,
+            shell=True,
+            text=True,
+        )
+        returncode = p.returncode
+    else:
+        options, name = current
+        os.makedirs(options.log_dir, exist_ok=True)
+        result = asyncio.run(
+            run_bash(
+                command,
+                log=os.path.join(options.log_dir, name + ".log"),
+                timeout=options.timeout,
+            )
+        )
+        if options.ledger is not None:
+            _record(options.ledger, name, result)
+        if result.timed_out:
+            raise ValueError(f"Timed out after {options.timeout}s")
+        returncode = result.returncode
+
+    if returncode != 0:
+        raise ValueError(f"Non-zero exit code: {returncode}")
+
+
+def bash_each(commands: dict[str, str], *, jobs, log_dir) -> dict[str, int | None]:
+    """Run many bash commands (by name) with run_bash, at most jobs at a time,
+    logging each to log_dir/NAME.log
+
+    In a step run with BashOptions (see bash_step), the commands are killed
+    after its timeout and recorded in its ledger (as STEP/NAME). Returns the
+    exit code of each command (None if it timed out)."""
+    current = _bash_step.get()
+    os.makedirs(log_dir, exist_ok=True)
+
+    async def run_one(semaphore, name, command):
+        async with semaphore:
+            result = await run_bash(
+                command,
+                log=os.path.join(log_dir, name + ".log"),
+                timeout=None if current is None else current[0].timeout,
+                echo=False,
+            )
+        if current is not None and current[0].ledger is not None:
+            _record(current[0].ledger, f"{current[1]}/{name}", result)
+        return result.returncode
+
+    async def run_all():
+        semaphore = asyncio.Semaphore(jobs)
+        return await asyncio.gather(
+            *(run_one(semaphore, name, command) for name, command in commands.items())
+        )
+
+    return dict(zip(commands, asyncio.run(run_all())))
+
+
+def compile_library(path) -> LibraryBuilder:
+    """Run the library module at path and collect its records"""
+    directory = os.path.dirname(os.path.abspath(path))
+    sys.path.insert(0, directory)
+    try:
+        with runtime_mode(False), LibraryBuilder() as lib:
+            runpy.run_path(path)
+    finally:
+        sys.path.remove(directory)
+    return lib
+
+
+SOURCE_HASH_PREFIX = "# honey_lang source hash: "
+
+
+def _source_hash(path):
+    with open(path, "rb") as f:
+        source = f.read()
+    h = hashlib.sha256(_honey_lang_hash().encode())
+    h.update(source)
+    return h.hexdigest()
+
+
+def _stored_source_hash(output):
+    try:
+        with open(output, "r") as f:
+            line = f.readline()
+    except OSError:
+        return None
+    if line.startswith(SOURCE_HASH_PREFIX):
+        return line[len(SOURCE_HASH_PREFIX) :].strip()
+    return None
+
+
+def _write_atomic(path, contents):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        f.write(contents)
+    os.replace(tmp, path)
+
+
+def _compile_job(path, output, source_hash):
+    start = time.perf_counter()
+    hits, misses = (_cache.hits, _cache.misses) if _cache else (0, 0)
+
+    lib = compile_library(path)
+    _write_atomic(output, f"{SOURCE_HASH_PREFIX}{source_hash}\n\n{lib.to_toml()}")
+
+    elapsed = time.perf_counter() - start
+    if _cache is None:
+        return elapsed, None
+    return elapsed, (_cache.hits - hits, _cache.misses - misses)
+
+
+def _library_paths(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for filename in sorted(os.listdir(path)):
+                if filename.endswith(".py") and not filename.startswith("_"):
+                    yield os.path.join(path, filename)
+        else:
+            yield path
+
+
+def compile_libraries(paths, *, out_dir=None, jobs=None, force=False) -> bool:
+    """Compile library modules to .hblib.toml files in a process pool
+
+    Libraries whose source (and honey_lang version) are unchanged since the
+    last compile are skipped. Returns whether all libraries compiled."""
+
+    ok = True
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {}
+        for path in _library_paths(paths):
+            base = os.path.splitext(os.path.basename(path))[0]
+            output = os.path.join(
+                out_dir or os.path.dirname(path),
+                base + ".hblib.toml",
+            )
+            source_hash = _source_hash(path)
+            if not force and _stored_source_hash(output) == source_hash:
+                print(f"{path}: unchanged, skipped")
+                continue
+            future = pool.submit(_compile_job, path, output, source_hash)
+            futures[future] = (path, output)
+
+        for future in concurrent.futures.as_completed(futures):
+            path, output = futures[future]
+            try:
+                elapsed, cache_stats = future.result()
+            except Exception as e:
+                print(f"{path}: error: {e}", file=sys.stderr)
+                ok = False
+                continue
+            message = f"{path}: {elapsed:.2f}s -> {output}"
+            if cache_stats is not None:
+                message += f" (cache: {cache_stats[0]} hits, {cache_stats[1]} misses)"
+            print(message)
+
+    return ok
+
+
+@dataclass(eq=False)
+class Step:
+    """A function application in a Honeybee expression"""
+
+    function: str
+    metadata: dict
+    args: dict[str, "Step"]
+    parent: "Step | None" = None
+    value: object = None
+    elapsed: float | None = None
+    key: str | None = None
+    cached: bool = False
+
+    def steps(self):
+        """All steps of the expression rooted here, dependencies first"""
+        for arg in self.args.values():
+            yield from arg.steps()
+        yield self
+
+
+def parse_expression(data, parent=None) -> Step:
+    """Parse an expression as serialized by the engine (interact -j)"""
+    if "Hole" in data:
+        raise ValueError(f"Expression is not complete (has hole {data['Hole']})")
+
+    f, args = data["App"]
+    step = Step(f["name"], f["metadata"], {}, parent)
+    for param, arg in args.items():
+        step.args[param] = parse_expression(arg, step)
+    return step
+
+
+class StepCache:
+    """Content-addressed cache of step outputs
+
+    A step is keyed by its function name, code, hyperparameters, return
+    metadata, and library helpers, along with the keys of its arguments (or,
+    for inputs, the SHA-256 hashes of the files they point to). Outputs are
+    moved into <directory>/<key[:2]>/<key> and linked back into the step's
+    output directory, so a cache hit only needs to create symlinks (and
+    deleting a cache entry breaks the links to it from earlier runs).
+
+    File hashes are remembered in <directory>/file-hashes.json, and a file is
+    only hashed again if its size, modification or change time, or inode
+    changed."""
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self._hashes_path = os.path.join(self.directory, "file-hashes.json")
+        try:
+            with open(self._hashes_path, "r") as f:
+                self._hashes = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self._hashes = {}
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def lookup(self, key):
+        path = self._path(key)
+        return path if os.path.isdir(path) else None
+
+    def store(self, key, output):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Move-then-rename so concurrent runs never see partial entries
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        os.makedirs(tmp)
+        for name in os.listdir(output):
+            shutil.move(os.path.join(output, name), os.path.join(tmp, name))
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # Another step with the same key finished first
+            shutil.rmtree(tmp)
+        self.materialize(key, output)
+
+    def materialize(self, key, output):
+        path = self._path(key)
+        for name in os.listdir(path):
+            os.symlink(src=os.path.join(path, name), dst=os.path.join(output, name))
+
+    def file_hash(self, file):
+        """SHA-256 hash of the contents of file"""
+        file = os.path.realpath(file)
+        st = os.stat(file)
+        stamp = [st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino]
+        known = self._hashes.get(file)
+        if known is not None and known[:-1] == stamp:
+            return known[-1]
+
+        h = hashlib.sha256()
+        with open(file, "rb") as f:
+            while block := f.read(1 << 20):
+                h.update(block)
+        self._hashes[file] = [*stamp, h.hexdigest()]
+
+        os.makedirs(self.directory, exist_ok=True)
+        _write_atomic(self._hashes_path, json.dumps(self._hashes))
+        return h.hexdigest()
+
+
+def _digest(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(b"\0")
+        h.update(part.encode())
+    return h.hexdigest()
+
+
+def _path_listing(path, cache):
+    """Content hashes of the files at (or under) path"""
+    if os.path.isfile(path):
+        return [cache.file_hash(path)]
+
+    listing = []
+    for root, dirs, files in os.walk(path, followlinks=True):
+        dirs.sort()
+        for name in sorted(files):
+            file = os.path.join(root, name)
+            listing.append(f"{os.path.relpath(file, path)} {cache.file_hash(file)}")
+    return listing
+
+
+def _metadata_listing(metadata, cache):
+    """The metadata, followed by the content hashes of the files at its
+    path-valued fields"""
+    parts = [json.dumps(metadata, sort_keys=True)]
+    for value in metadata.values():
+        if isinstance(value, str) and os.path.exists(value):
+            parts.extend(_path_listing(value, cache))
+    return parts
+
+
+def _input_key(name, metadata, cache):
+    return _digest(name, *_metadata_listing(metadata, cache))
+
+
+def _function_step_key(f, helpers, step, cache):
+    info = _function_info(f)
+    return _digest(
+        step.function,
+        info.code,
+        repr([(param.name, param.default) for param in info.hyper_parameters]),
+        *_metadata_listing(step.metadata, cache),
+        *helpers,
+        *(f"{param}={arg.key}" for param, arg in step.args.items()),
+    )
+
+
+class _OutputDirs:
+    """Makes numbered output directories for steps under one output-<time>
+    directory (like the Dir helper of the standard library)"""
+
+    def __init__(self):
+        time = datetime.datetime.today().strftime("%Y-%m-%d-%H-%M-%S")
+        self.root = f"output-{time}"
+        self.stage = 1
+
+    def make(self, name):
+        dir = f"{self.root}/{self.stage * 10:03d}-{name}"
+        os.makedirs(dir, exist_ok=True)
+        self.stage += 1
+        return dir
+
+
+def _output_dir_maker(module):
+    """The library's Dir.make if it defines one, or else a new _OutputDirs"""
+    if not hasattr(module, "Dir"):
+        return _OutputDirs().make
+    make = getattr(module.Dir, "make", None)
+    if not callable(make):
+        raise ValueError(
+            f"Library '{module.__name__}' defines Dir, but not Dir.make(name)"
+        )
+    return make
+
+
+def _prepare_step(make_dir, functions, types, helpers, cache, bash, step):
+    """Return a thunk that runs the step (constructing its return object now)"""
+    if step.function.startswith("F_") and step.function[2:] in types:
+        cls = types[step.function[2:]]
+        if cache is not None:
+            step.key = _input_key(step.function, step.metadata, cache)
+        return lambda: cls(**step.metadata)
+
+    try:
+        f = functions[step.function]
+    except KeyError:
+        raise ValueError(f"Unknown function '{step.function}'")
+
+    ret_cls = inspect.signature(f, eval_str=True).parameters["__hb_ret"].annotation
+    ret = ret_cls(path=make_dir(step.function), **step.metadata)
+    kwargs = {f"__hb_{param}": arg.value for param, arg in step.args.items()}
+
+    if cache is not None:
+        step.key = _function_step_key(f, helpers, step, cache)
+
+    def run():
+        if cache is not None and cache.lookup(step.key) is not None:
+            cache.materialize(step.key, ret.path)
+            step.cached = True
+            return ret
+        if bash is None:
+            f(**kwargs, __hb_ret=ret)
+        else:
+            with bash_step(bash, os.path.basename(ret.path)):
+                f(**kwargs, __hb_ret=ret)
+        if cache is not None:
+            cache.store(step.key, ret.path)
+        return ret
+
+    return run
+
+
+def _timed(thunk):
+    start = time.perf_counter()
+    value = thunk()
+    return value, time.perf_counter() - start
+
+
+def run_expression(module, expression: Step, *, jobs=None, cache=None, bash=None):
+    """Run an expression against a library module (e.g. from load_library)
+
+    Each step runs in a bounded thread pool as soon as all of its arguments
+    have been computed, so independent sub-expressions run concurrently.
+    Return objects (and their output directories) are created by the
+    scheduling thread, in a deterministic order (with the library's Dir.make
+    if it defines one, and otherwise numbered under a new output-<time>
+    directory). If a StepCache is given, steps whose outputs are cached are
+    linked in rather than run. If BashOptions are given, the commands of each
+    step are run with run_bash (and logged to a file per step). Returns the
+    value of the expression; the wall time of each step is stored on it."""
+
+    functions = {}
+    types = {}
+    helpers = []
+    for definition in definitions(module):
+        if definition.kind == "Function":
+            functions[definition.obj.__name__] = definition.obj
+        elif definition.kind == "Input":
+            types[definition.obj.__name__] = definition.obj
+        elif definition.kind == "Helper" and inspect.isclass(definition.obj):
+            helpers.append(_class_info(definition.obj).source)
+        elif definition.kind == "Helper":
+            helpers.append(_function_info(definition.obj).source)
+
+    make_dir = _output_dir_maker(module)
+    remaining = {step: len(step.args) for step in expression.steps()}
+
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    running = {}
+
+    def submit(step):
+        thunk = _prepare_step(make_dir, functions, types, helpers, cache, bash, step)
+        running[pool.submit(_timed, thunk)] = step
+
+    try:
+        for step, count in remaining.items():
+            if count == 0:
+                submit(step)
+
+        while running:
+            done, _ = concurrent.futures.wait(
+                running,
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            for future in done:
+                step = running.pop(future)
+                step.value, step.elapsed = future.result()
+                cached = " (cached)" if step.cached else ""
+                print(f"{step.function}: {step.elapsed:.2f}s{cached}")
+                if step.parent is not None:
+                    remaining[step.parent] -= 1
+                    if remaining[step.parent] == 0:
+                        submit(step.parent)
+    except BaseException:
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+
+    pool.shutdown()
+    return expression.value
+
+
+def run_program(
+    library,
+    expression_path,
+    *,
+    jobs=None,
+    cache_dir=None,
+    bash=None,
+):
+    """Run a serialized expression (from interact -j) against a library"""
+    module = load_library(library)
+    with open(expression_path, "r") as f:
+        expression = parse_expression(json.load(f))
+
+    cache = StepCache(cache_dir) if cache_dir else None
+
+    start = time.perf_counter()
+    run_expression(module, expression, jobs=jobs, cache=cache, bash=bash)
+    elapsed = time.perf_counter() - start
+
+    total = sum(step.elapsed for step in expression.steps())
+    print(f"Finished in {elapsed:.2f}s ({total:.2f}s of step time)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="honey_lang",
+        description="Define Honeybee libraries using Python",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    compile_parser = subparsers.add_parser(
+        "compile",
+        help="Compile library modules (or directories of them) to .hblib.toml",
+    )
+    compile_parser.add_argument("paths", nargs="+", metavar="PATH")
+    compile_parser.add_argument(
+        "-o",
+        "--out-dir",
+        metavar="DIR",
+        help="Directory to write libraries to (default: next to each module)",
+    )
+    compile_parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        metavar="N",
+        help="Number of libraries to compile in parallel (default: CPU count)",
+    )
+    compile_parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="Recompile libraries even if their source is unchanged",
+    )
+    compile_parser.add_argument(
+        "-c",
+        "--cache",
+        metavar="DIR",
+        help="Fragment cache directory (default: $HONEY_LANG_CACHE)",
+    )
+
+    run_parser = subparsers.add_parser(
+        "run",
+        help="Run an expression (from interact -j) against a library module",
+    )
+    run_parser.add_argument("library", metavar="LIBRARY")
+    run_parser.add_argument("expression", metavar="JSON")
+    run_parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        metavar="N",
+        help="Maximum number of steps to run in parallel (default: CPU count)",
+    )
+    run_parser.add_argument(
+        "-c",
+        "--cache",
+        metavar="DIR",
+        default=os.environ.get("HONEY_LANG_STEP_CACHE"),
+        help="Step output cache directory (default: $HONEY_LANG_STEP_CACHE)",
+    )
+    run_parser.add_argument(
+        "--log-dir",
+        metavar="DIR",
+        default="honey_lang-logs",
+        help="Directory for the command logs of each step (default: honey_lang-logs)",
+    )
+    run_parser.add_argument(
+        "--timeout",
+        type=float,
+        metavar="SECONDS",
+        help="Kill any command that runs for longer than this",
+    )
+    run_parser.add_argument(
+        "--ledger",
+        metavar="PATH",
+        help="JSON Lines file to append the wall time, CPU time, and peak "
+        "memory of each command to (default: LOG_DIR/ledger.jsonl)",
     )
 
-    if p.returncode != 0:
-        raise ValueError(f"Non-zero exit code: {p.returncode}")
+    args = parser.parse_args(argv)
+
+    if args.command == "compile":
+        if args.cache:
+            # Also picked up by workers that do not fork from this process
+            os.environ["HONEY_LANG_CACHE"] = args.cache
+            enable_cache(args.cache)
+        if args.out_dir:
+            os.makedirs(args.out_dir, exist_ok=True)
+        ok = compile_libraries(
+            args.paths,
+            out_dir=args.out_dir,
+            jobs=args.jobs,
+            force=args.force,
+        )
+        sys.exit(0 if ok else 1)
+    elif args.command == "run":
+        run_program(
+            args.library,
+            args.expression,
+            jobs=args.jobs,
+            cache_dir=args.cache,
+            bash=BashOptions(
+                log_dir=args.log_dir,
+                timeout=args.timeout,
+                ledger=args.ledger or os.path.join(args.log_dir, "ledger.jsonl"),
+            ),
+        )
@@ -0,0 +1,149 @@
+"""Benchmark native transcript aggregation (tximport_native) against tximport
+
+Generates synthetic kallisto output (abundance.tsv for each sample) and a
+tx2gene table, then times the native aggregation and, if Rscript and the
+tximport package are available, the equivalent tximport call (checking that
+their results agree).
+
+Usage: uv run python benchmark_tximport.py [--transcripts N] [--samples N]"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+import polars as pl
+
+import honey_lang
+
+TXIMPORT_R = """
+library(tximport)
+args = commandArgs(trailingOnly = TRUE)
+metadata = read.csv(args[1], header = TRUE)
+files = file.path(args[2], metadata$sample_name, "abundance.tsv")
+names(files) = metadata$sample_name
+tx2gene = read.csv(args[3], header = TRUE)
+txi = tximport(files, type = "kallisto", tx2gene = tx2gene)
+write.csv(txi$counts, file.path(args[4], "counts.csv"))
+write.csv(txi$abundance, file.path(args[4], "abundance.csv"))
+"""
+
+
+def generate(directory, *, transcripts, genes, samples, seed=0):
+    rng = np.random.default_rng(seed)
+
+    target_id = [f"ENST{i:011d}.1" for i in range(transcripts)]
+    gene_id = [f"ENSG{g:011d}.1" for g in rng.integers(0, genes, transcripts)]
+    tx2gene = pl.DataFrame(
+        {
+            "ensembl_transcript_id_version": target_id,
+            "ensembl_gene_id_version": gene_id,
+        }
+    )
+    tx2gene.write_parquet(f"{directory}/tx2gene.parquet")
+    tx2gene.write_csv(f"{directory}/tx2gene.csv")
+
+    length = rng.integers(300, 10_000, transcripts)
+    eff_length = np.maximum(length - 200, 1).astype(float)
+    sample_names = [f"S{i:03d}" for i in range(samples)]
+    for sample_name in sample_names:
+        os.makedirs(f"{directory}/kallisto/{sample_name}")
+        est_counts = rng.negative_binomial(2, 0.01, transcripts).astype(float)
+        rate = est_counts / eff_length
+        pl.DataFrame(
+            {
+                "target_id": target_id,
+                "length": length,
+                "eff_length": eff_length,
+                "est_counts": est_counts,
+                "tpm": 1e6 * rate / rate.sum(),
+            }
+        ).write_csv(
+            f"{directory}/kallisto/{sample_name}/abundance.tsv",
+            separator="\t",
+        )
+
+    pl.DataFrame({"sample_name": sample_names}).write_csv(
+        f"{directory}/kallisto/sample_sheet.csv"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--transcripts", type=int, default=200_000)
+    parser.add_argument("--genes", type=int, default=60_000)
+    parser.add_argument("--samples", type=int, default=100)
+    args = parser.parse_args()
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    std_bio = honey_lang.load_library(f"{here}/../std-bio.py")
+
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        generate(
+            directory,
+            transcripts=args.transcripts,
+            genes=args.genes,
+            samples=args.samples,
+        )
+        print(f"Generated data in {time.perf_counter() - start:.2f}s")
+
+        sample_names = pl.read_csv(f"{directory}/kallisto/sample_sheet.csv")[
+            "sample_name"
+        ]
+
+        start = time.perf_counter()
+        counts, abundance = std_bio.aggregate_transcripts(
+            {
+                sample_name: f"{directory}/kallisto/{sample_name}/abundance.tsv"
+                for sample_name in sample_names
+            },
+            f"{directory}/tx2gene.parquet",
+        )
+        counts.write_csv(f"{directory}/counts.csv")
+        abundance.write_csv(f"{directory}/abundance.csv")
+        native = time.perf_counter() - start
+        print(f"Native: {native:.2f}s")
+
+        if shutil.which("Rscript") is None:
+            print("R: skipped (Rscript not found)")
+            return
+
+        os.makedirs(f"{directory}/r")
+        with open(f"{directory}/tximport.r", "w") as f:
+            f.write(TXIMPORT_R)
+        start = time.perf_counter()
+        p = subprocess.run(
+            [
+                "Rscript",
+                f"{directory}/tximport.r",
+                f"{directory}/kallisto/sample_sheet.csv",
+                f"{directory}/kallisto",
+                f"{directory}/tx2gene.csv",
+                f"{directory}/r",
+            ],
+        )
+        if p.returncode != 0:
+            print("R: skipped (tximport failed)")
+            return
+        r = time.perf_counter() - start
+        print(f"R: {r:.2f}s ({r / native:.1f}x slower than native)")
+
+        for name, native_matrix in [("counts", counts), ("abundance", abundance)]:
+            r_matrix = (
+                pl.read_csv(f"{directory}/r/{name}.csv")
+                .rename({"": "gene_id"})
+                .sort("gene_id")
+            )
+            difference = np.abs(
+                r_matrix.drop("gene_id").to_numpy()
+                - native_matrix.drop("gene_id").to_numpy()
+            ).max()
+            print(f"Maximum {name} difference: {difference:.3g}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,6 @@
 ################################################################################
 # %% Imports
 
-library(tidyverse)
-library(biomaRt)
 library(DESeq2)
 
 ################################################################################
@@ -10,38 +8,18 @@ library(DESeq2)
 
 args = commandArgs(trailingOnly = TRUE)
 
-ENSEMBL_VERSION = args[1]
-ENSEMBL_DATASET = args[2]
-SAMPLE_SHEET = args[3]
-COMPARISON_SHEET = args[4]
-GENE_COUNTS = args[5]
-OUTPUT_DIR = args[6]
+GENE_METADATA = args[1]
+SAMPLE_SHEET = args[2]
+COMPARISON_SHEET = args[3]
+GENE_COUNTS = args[4]
+OUTPUT_DIR = args[5]
 
 ################################################################################
 # %% Main script
 
-# Get gene metadata
+# Load gene metadata (from the local Ensembl annotation store)
 
-mart = useEnsembl(
-    biomart = "ensembl",
-    dataset = ENSEMBL_DATASET,
-    version = ENSEMBL_VERSION
-)
-
-gene_metadata = getBM(
-    attributes = c(
-          "ensembl_gene_id",
-          "ensembl_gene_id_version",
-          "chromosome_name",
-          "start_position",
-          "end_position",
-          "external_gene_name",
-          "gene_biotype"
-    ),
-    mart = mart
-)
-
-write_csv(gene_metadata, file.path(OUTPUT_DIR, "gene_metadata.csv"))
+gene_metadata = read.csv(GENE_METADATA, header = TRUE)
 
 protein_coding = gene_metadata[
     gene_metadata$gene_biotype == "protein_coding",
@@ -0,0 +1,55 @@
+"""Fill the local Ensembl annotation store used by std-bio steps
+
+Run this on a machine with network access (with the same ENSEMBL_CACHE_DIR as
+the pipeline) so that tximport and deseq2 steps never need to download
+annotations, e.g. on air-gapped compute nodes.
+
+Usage: uv run python prefetch_ensembl.py [--version V] [--dataset D] ..."""
+
+import argparse
+import os
+
+import honey_lang
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--version",
+        action="append",
+        help="Ensembl release (repeatable, default: 115)",
+    )
+    parser.add_argument(
+        "--dataset",
+        action="append",
+        help="BioMart dataset (repeatable, default: hsapiens_gene_ensembl)",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default="~/.cache/honeybee/ensembl",
+        help="annotation store directory (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--url",
+        default="https://www.ensembl.org/biomart/martservice",
+        help="BioMart to download from (default: %(default)s)",
+    )
+    args = parser.parse_args()
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    std_bio = honey_lang.load_library(f"{here}/../std-bio.py")
+
+    for dataset in args.dataset or ["hsapiens_gene_ensembl"]:
+        for version in args.version or ["115"]:
+            annotations = std_bio.EnsemblAnnotations(
+                args.cache_dir,
+                dataset=dataset,
+                version=version,
+                url=args.url,
+            )
+            for path in annotations.prefetch():
+                print(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,18 +3,16 @@
 ################################################################################
 # %% Imports
 
-library(biomaRt)
 library(tximport)
 
 ################################################################################
 # %% Command-line arguments
 
 args = commandArgs(trailingOnly = TRUE)
-ENSEMBL_VERSION = args[1]
-ENSEMBL_DATASET = args[2]
-SAMPLE_SHEET = args[3]
-TRANSCRIPT_DIR = args[4]
-OUTPUT_DIR = args[5]
+TX2GENE = args[1]
+SAMPLE_SHEET = args[2]
+TRANSCRIPT_DIR = args[3]
+OUTPUT_DIR = args[4]
 
 ################################################################################
 # %% Main script
@@ -31,20 +29,9 @@ files = file.path(
 
 names(files) = metadata$sample
 
-# %% Create tx2gene using biomaRt
+# %% Load tx2gene (from the local Ensembl annotation store)
 
-mart = useEnsembl(
-    biomart = "ensembl",
-    dataset = ENSEMBL_DATASET,
-    version = ENSEMBL_VERSION
-)
-
-tx2gene = getBM(
-    attributes =
-        c("ensembl_transcript_id_version",
-          "ensembl_gene_id_version"),
-    mart = mart
-)
+tx2gene = read.csv(TX2GENE, header = TRUE)
 
 # %% Aggregate abundances and save count file
 
@@ -1,5 +1,19 @@
 import os
 import datetime
+import subprocess
+import tempfile
+import concurrent.futures
+import gzip
+import hashlib
+import http.client
+import io
+import json
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import xml.etree.ElementTree as ET
+import numpy as np
 import polars as pl
 
 from honey_lang import Helper, Input, Output, Function, __hb_bash
@@ -33,6 +47,460 @@ def carry_over(src_object, dst_object, *, file=None):
         carry_one(file)
 
 
+@Helper
+def for_each_sample(sample_names, command, *, jobs, log_dir):
+    """Run the bash command command(sample_name) for each sample (at most jobs
+    at a time), saving the output for each to log_dir/SAMPLE_NAME.log
+
+    In a step of honey_lang run, the commands go through its bash runner (with
+    its timeout and usage ledger); elsewhere (such as in generated scripts and
+    notebooks, which may already be running an event loop), they are run with
+    subprocess."""
+
+    os.makedirs(log_dir, exist_ok=True)
+
+    try:
+        from honey_lang import bash_each, in_bash_step
+
+        use_runner = in_bash_step()
+    except ImportError:
+        use_runner = False
+
+    def run_one(sample_name):
+        with open(f"{log_dir}/{sample_name}.log", "w") as log:
+            p = subprocess.run(
+                command(sample_name),
+                shell=True,
+                text=True,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+            )
+        return p.returncode
+
+    if not use_runner:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+            returncodes = dict(zip(sample_names, pool.map(run_one, sample_names)))
+    else:
+        returncodes = bash_each(
+            {sample_name: command(sample_name) for sample_name in sample_names},
+            jobs=jobs,
+            log_dir=log_dir,
+        )
+
+    for sample_name, rc in returncodes.items():
+        status = "timed out" if rc is None else f"exit code {rc}"
+        print(f"{sample_name}: {status} (log: {log_dir}/{sample_name}.log)")
+
+    failed = [sample_name for sample_name, rc in returncodes.items() if rc != 0]
+    if failed:
+        raise ValueError(f"Non-zero exit code for samples: {', '.join(failed)}")
+
+
+@Helper
+def worker_pool(jobs):
+    """A pool of jobs threads for the NumPy helpers below
+
+    Steps may run on the threads of honey_lang run, where forking a process
+    pool could deadlock the children (on locks held by other threads), and
+    spawned processes could not import helpers defined in a library or
+    notebook. The helpers spend most of their time in NumPy and zlib, which
+    release the GIL, so threads still run them in parallel."""
+
+    return concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+
+
+@Helper
+def download_file(url, path, *, md5, retries=5):
+    """Download url to path, resuming from path.part (with an HTTP range
+    request) if a previous attempt was interrupted, and verify its MD5"""
+
+    if os.path.exists(path):
+        return
+
+    part = path + ".part"
+
+    for attempt in range(retries):
+        h = hashlib.md5()
+        offset = 0
+        if os.path.exists(part):
+            with open(part, "rb") as f:
+                while chunk := f.read(1 << 20):
+                    h.update(chunk)
+                    offset += len(chunk)
+
+        request = urllib.request.Request(url)
+        if offset > 0:
+            request.add_header("Range", f"bytes={offset}-")
+
+        try:
+            with urllib.request.urlopen(request, timeout=60) as response:
+                if offset > 0 and response.status != 206:
+                    # Server ignored the range request, so start over
+                    h = hashlib.md5()
+                    offset = 0
+                with open(part, "ab" if offset > 0 else "wb") as f:
+                    while chunk := response.read(1 << 20):
+                        f.write(chunk)
+                        h.update(chunk)
+                if response.length:
+                    # Connection closed early; resume on the next attempt
+                    raise http.client.IncompleteRead(b"", response.length)
+        except urllib.error.HTTPError as e:
+            # Range not satisfiable: the partial file is already complete
+            if e.code != 416 and e.code < 500:
+                raise
+            if e.code != 416:
+                print(f"{url}: {e} (attempt {attempt + 1} of {retries})")
+                time.sleep(2**attempt)
+                continue
+        except (OSError, http.client.HTTPException) as e:
+            print(f"{url}: {e} (attempt {attempt + 1} of {retries})")
+            time.sleep(2**attempt)
+            continue
+
+        if h.hexdigest() == md5:
+            os.replace(part, path)
+            return
+
+        print(f"{url}: MD5 mismatch (attempt {attempt + 1} of {retries})")
+        os.remove(part)
+
+    raise ValueError(f"Failed to download {url}")
+
+
+@Helper
+def download_from_ena(accessions, directory, *, jobs, api_url):
+    """Download the paired-end FASTQ files for run accessions from the ENA
+    (at most jobs files at a time), verifying their MD5s
+
+    File locations and MD5s come from the ENA filereport at api_url."""
+
+    downloads = []
+    for accession in accessions:
+        report_url = (
+            f"{api_url}?accession={accession}&result=read_run"
+            "&fields=fastq_ftp,fastq_md5&format=tsv"
+        )
+        with urllib.request.urlopen(report_url, timeout=60) as response:
+            header, *rows = response.read().decode().splitlines()
+
+        columns = header.split("\t")
+        for row in rows:
+            report = dict(zip(columns, row.split("\t")))
+            urls = report["fastq_ftp"].split(";")
+            md5s = report["fastq_md5"].split(";")
+            for url, md5 in zip(urls, md5s):
+                filename = url.rsplit("/", 1)[-1]
+                # Skip unpaired reads
+                if not filename.endswith(("_1.fastq.gz", "_2.fastq.gz")):
+                    continue
+                if "://" not in url:
+                    url = "https://" + url
+                downloads.append((url, f"{directory}/{filename}", md5))
+
+        for read in [1, 2]:
+            if not any(
+                path.endswith(f"/{accession}_{read}.fastq.gz")
+                for _, path, _ in downloads
+            ):
+                raise ValueError(f"No _{read}.fastq.gz reads for {accession}")
+
+    def download(url, path, md5):
+        download_file(url, path, md5=md5)
+        print(f"Downloaded {path}")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        for future in [pool.submit(download, *d) for d in downloads]:
+            future.result()
+
+
+@Helper
+class SampleSheet:
+    """The sample sheet of a directory of paired-end reads, validated (and
+    with the FASTQ files of every sample found) before any tool runs
+
+    If index_dir is given, the validated sheet is saved there as an Arrow IPC
+    file (sample_sheet.arrow). Steps that carry the reads over pass their own
+    output directory, so later steps reading that directory memory map the
+    index instead of re-parsing the sheet; the directory itself (which may be
+    an earlier, cached step) is never written to."""
+
+    def __init__(self, directory, *, index_dir=None):
+        self.directory = directory
+        table = self._cached()
+        if table is None:
+            table = self._index()
+            if index_dir is not None:
+                self._save(table, index_dir)
+        self.table = table
+        self.sample_names = table["sample_name"].to_list()
+        self._fastqs = {
+            sample_name: (f"{directory}/{fastq_1}", f"{directory}/{fastq_2}")
+            for sample_name, fastq_1, fastq_2 in table.select(
+                "sample_name", "fastq_1", "fastq_2"
+            ).iter_rows()
+        }
+
+    def fastqs(self, sample_name):
+        """The forward and reverse FASTQ paths of a sample"""
+        return self._fastqs[sample_name]
+
+    def all_fastqs(self):
+        return [path for name in self.sample_names for path in self._fastqs[name]]
+
+    def _stat(self, files):
+        """Sizes and modification times of files in the directory"""
+        sizes, mtimes, missing = [], [], []
+        for file in files:
+            try:
+                st = os.stat(f"{self.directory}/{file}")
+            except FileNotFoundError:
+                missing.append(file)
+                continue
+            sizes.append(st.st_size)
+            mtimes.append(st.st_mtime_ns)
+        if missing:
+            raise FileNotFoundError(
+                f"Missing FASTQ files in {self.directory}: {', '.join(missing)}"
+            )
+        return sizes, mtimes
+
+    def _cached(self):
+        try:
+            # Polars memory maps uncompressed IPC files
+            table = pl.read_ipc(f"{self.directory}/sample_sheet.arrow")
+            sheet = os.stat(f"{self.directory}/sample_sheet.csv")
+            if table.height == 0:
+                return None
+            if table["sheet_size"][0] != sheet.st_size:
+                return None
+            if table["sheet_mtime_ns"][0] != sheet.st_mtime_ns:
+                return None
+            for read in [1, 2]:
+                sizes, mtimes = self._stat(table[f"fastq_{read}"])
+                if sizes != table[f"size_{read}"].to_list():
+                    return None
+                if mtimes != table[f"mtime_{read}"].to_list():
+                    return None
+        except (OSError, KeyError, pl.exceptions.PolarsError):
+            return None
+        return table
+
+    def _index(self):
+        path = f"{self.directory}/sample_sheet.csv"
+        sheet = os.stat(path)
+        table = pl.read_csv(path)
+
+        if "sample_name" not in table.columns:
+            raise ValueError(f"{path}: missing sample_name column")
+        if table.height == 0:
+            raise ValueError(f"{path}: no samples")
+        names = table["sample_name"].cast(pl.String)
+        if names.null_count() > 0:
+            raise ValueError(f"{path}: empty sample_name")
+        duplicates = names.filter(names.is_duplicated()).unique().to_list()
+        if duplicates:
+            raise ValueError(f"{path}: duplicate samples {', '.join(duplicates)}")
+
+        table = table.with_columns(
+            sample_name=names,
+            fastq_1=names + "_1.fastq.gz",
+            fastq_2=names + "_2.fastq.gz",
+            sheet_size=pl.lit(sheet.st_size, dtype=pl.Int64),
+            sheet_mtime_ns=pl.lit(sheet.st_mtime_ns, dtype=pl.Int64),
+        )
+
+        for read in [1, 2]:
+            sizes, mtimes = self._stat(table[f"fastq_{read}"])
+            table = table.with_columns(
+                pl.Series(f"size_{read}", sizes, dtype=pl.Int64),
+                pl.Series(f"mtime_{read}", mtimes, dtype=pl.Int64),
+            )
+
+        return table
+
+    def _save(self, table, index_dir):
+        # Write-then-rename so concurrent readers never see partial files
+        fd, tmp = tempfile.mkstemp(dir=index_dir, suffix=".arrow.tmp")
+        os.close(fd)
+        try:
+            table.write_ipc(tmp, compression="uncompressed")
+            os.replace(tmp, f"{index_dir}/sample_sheet.arrow")
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+
+@Helper
+class EnsemblAnnotations:
+    """Local store of Ensembl gene annotations, with one Parquet file per
+    BioMart table in cache_dir/dataset/version
+
+    Tables missing from the store are downloaded once from the BioMart at url
+    (which must serve Ensembl release version). Machines without network
+    access can use a store filled beforehand by prefetch (see
+    environment/prefetch_ensembl.py)."""
+
+    TABLES = {
+        "tx2gene": ["ensembl_transcript_id_version", "ensembl_gene_id_version"],
+        "gene_metadata": [
+            "ensembl_gene_id",
+            "ensembl_gene_id_version",
+            "chromosome_name",
+            "start_position",
+            "end_position",
+            "external_gene_name",
+            "gene_biotype",
+        ],
+    }
+
+    def __init__(self, cache_dir, *, dataset, version, url):
+        self.directory = f"{os.path.expanduser(cache_dir)}/{dataset}/{version}"
+        self.dataset = dataset
+        self.version = version
+        self.url = url
+
+    def path(self, table):
+        """Path to the Parquet file of a table, downloading it if needed"""
+        path = f"{self.directory}/{table}.parquet"
+        if not os.path.exists(path):
+            try:
+                self._download(table, path)
+            except urllib.error.URLError as e:
+                raise FileNotFoundError(
+                    f"{path} is not in the annotation store and could not be "
+                    f"downloaded ({e.reason}); prefetch it on a machine with "
+                    "network access"
+                ) from e
+        return path
+
+    def write_csv(self, table, path):
+        """Copy a table to a CSV file (e.g. for R scripts)"""
+        pl.read_parquet(self.path(table)).write_csv(path)
+
+    def prefetch(self):
+        """Download every table that is not yet in the store"""
+        return [self.path(table) for table in self.TABLES]
+
+    def _download(self, table, path):
+        with urllib.request.urlopen(f"{self.url}?type=registry", timeout=60) as r:
+            registry = ET.fromstring(r.read())
+        releases = [
+            location.get("displayName")
+            for location in registry.iter("MartURLLocation")
+            if location.get("name") == "ENSEMBL_MART_ENSEMBL"
+        ]
+        if releases != [f"Ensembl Genes {self.version}"]:
+            raise ValueError(
+                f"{self.url} serves {releases}, not Ensembl Genes {self.version}"
+            )
+
+        attributes = self.TABLES[table]
+        query = (
+            '<?xml version="1.0" encoding="UTF-8"?><!DOCTYPE Query>'
+            '<Query virtualSchemaName="default" formatter="TSV" header="0" '
+            'uniqueRows="1" completionStamp="1">'
+            f'<Dataset name="{self.dataset}" interface="default">'
+            + "".join(f'<Attribute name="{attribute}"/>' for attribute in attributes)
+            + "</Dataset></Query>"
+        )
+        with urllib.request.urlopen(
+            f"{self.url}?query={urllib.parse.quote(query)}", timeout=600
+        ) as r:
+            body = r.read()
+
+        # BioMart silently truncates results on errors
+        body, _, stamp = body.rstrip(b"\n").rpartition(b"\n")
+        if stamp != b"[success]":
+            raise ValueError(f"Incomplete BioMart response for {self.dataset}")
+
+        data = pl.read_csv(
+            io.BytesIO(body),
+            separator="\t",
+            has_header=False,
+            new_columns=attributes,
+            infer_schema_length=0,
+        )
+
+        # Write-then-rename so concurrent steps never see partial files
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        data.write_parquet(tmp)
+        os.replace(tmp, path)
+
+
+@Helper
+def aggregate_transcripts(abundances, tx2gene):
+    """Gene-level estimated counts and TPM matrices (genes by samples, as
+    computed by tximport for kallisto) from the kallisto abundance.tsv files of
+    each sample and a tx2gene Parquet table (transcript and gene columns)"""
+
+    # Like tximport, this requires all samples to list the same transcripts in
+    # the same order (as kallisto does for a given index), so the samples are
+    # read side by side and each transcript is mapped to its gene only once
+
+    transcript, gene = pl.read_parquet_schema(tx2gene).keys()
+    first = next(iter(abundances))
+
+    transcripts = (
+        pl.concat(
+            [
+                pl.scan_csv(path, separator="\t").select(
+                    pl.col("target_id").alias(f"target_id:{sample}"),
+                    pl.col("est_counts").alias(f"est_counts:{sample}"),
+                    pl.col("tpm").alias(f"tpm:{sample}"),
+                )
+                for sample, path in abundances.items()
+            ],
+            how="horizontal",
+        )
+        .select(
+            pl.col(f"target_id:{first}").alias("target_id"),
+            pl.all_horizontal(
+                pl.col(f"target_id:{sample}") == pl.col(f"target_id:{first}")
+                for sample in abundances
+            ).alias("consistent"),
+            pl.col("^(est_counts|tpm):.*$"),
+        )
+        .collect()
+    )
+
+    if not transcripts["consistent"].all():
+        raise ValueError("Samples do not list the same transcripts in order")
+
+    mapping = pl.scan_parquet(tx2gene).select(
+        pl.col(transcript).alias("target_id"),
+        pl.col(gene).alias("gene_id"),
+    )
+
+    genes, unmatched = pl.collect_all(
+        [
+            transcripts.lazy()
+            .drop("consistent")
+            .join(mapping, on="target_id")
+            .group_by("gene_id")
+            .agg(pl.exclude("target_id").sum())
+            .sort("gene_id"),
+            transcripts.lazy()
+            .join(mapping, on="target_id", how="anti")
+            .select(pl.len()),
+        ]
+    )
+
+    if genes.height == 0:
+        raise ValueError("None of the transcripts are in tx2gene")
+    if unmatched.item() > 0:
+        print(f"transcripts missing from tx2gene: {unmatched.item()}")
+
+    return [
+        genes.select(
+            "gene_id",
+            *(pl.col(f"{values}:{sample}").alias(sample) for sample in abundances),
+        )
+        for values in ["est_counts", "tpm"]
+    ]
+
+
 ################################################################################
 # %% Raw RNA-seq data (reads)
 
@@ -126,23 +594,20 @@ def from_sra_rna_seq(__hb_sra: SraRnaSeq, __hb_ret: RnaSeqReads):
     filenames for the forward reads ending in _1.fastq.gz and the filenames for
     the reverse reads ending in _2.fastq.gz."""
 
-    sample_sheet = pl.read_csv(__hb_sra.sample_sheet)
-
-    for srr in sample_sheet["sample_name"]:
-        base_url = "ftp://ftp.sra.ebi.ac.uk/vol1/fastq/"
-        base_url += srr[:6] + "/"
-        base_url += srr[9:].zfill(3) + "/"
-        base_url += srr + "/"
+    # PARAMETER: The number of files to download at the same time
+    ENA_CONCURRENT_DOWNLOADS = 4
 
-        # Assumes forward (_1) and reverse (_2) reads exist
+    # PARAMETER: The ENA file report API to look up FASTQ locations with
+    ENA_FILEREPORT_URL = "https://www.ebi.ac.uk/ena/portal/api/filereport"
 
-        __hb_bash(f"""
-             wget -nc --directory-prefix={__hb_ret.path} {base_url}{srr}_1.fastq.gz
-        """)
+    sample_sheet = pl.read_csv(__hb_sra.sample_sheet)
 
-        __hb_bash(f"""
-             wget -nc --directory-prefix={__hb_ret.path} {base_url}{srr}_2.fastq.gz
-        """)
+    download_from_ena(
+        sample_sheet["sample_name"],
+        __hb_ret.path,
+        jobs=ENA_CONCURRENT_DOWNLOADS,
+        api_url=ENA_FILEREPORT_URL,
+    )
 
     os.symlink(
         src=__hb_sra.sample_sheet,
@@ -196,11 +661,8 @@ def fastqc(__hb_reads: RnaSeqReads, __hb_ret: RnaSeqReads):
 
     carry_over(__hb_reads, __hb_ret)
 
-    sample_sheet = pl.read_csv(f"{__hb_reads.path}/sample_sheet.csv")
-    fastqs = " ".join(
-        (__hb_reads.path + "/" + sample_sheet["sample_name"] + "_1.fastq.gz ")
-        + (__hb_reads.path + "/" + sample_sheet["sample_name"] + "_2.fastq.gz")
-    )
+    sample_sheet = SampleSheet(__hb_reads.path, index_dir=__hb_ret.path)
+    fastqs = " ".join(sample_sheet.all_fastqs())
 
     __hb_bash(f"""fastqc -t {FASTQC_CORES} -o {__hb_ret.path} {fastqs}""")
 
@@ -243,11 +705,8 @@ def multiqc(__hb_reads: RnaSeqReads, __hb_ret: RnaSeqReads):
 
     carry_over(__hb_reads, __hb_ret)
 
-    sample_sheet = pl.read_csv(f"{__hb_reads.path}/sample_sheet.csv")
-    fastqs = " ".join(
-        (__hb_reads.path + "/" + sample_sheet["sample_name"] + "_1.fastq.gz ")
-        + (__hb_reads.path + "/" + sample_sheet["sample_name"] + "_2.fastq.gz")
-    )
+    sample_sheet = SampleSheet(__hb_reads.path, index_dir=__hb_ret.path)
+    fastqs = " ".join(sample_sheet.all_fastqs())
 
     __hb_bash(f"""fastqc -t {FASTQC_CORES} -o {__hb_ret.path} {fastqs}""")
     __hb_bash(
@@ -255,6 +714,411 @@ def multiqc(__hb_reads: RnaSeqReads, __hb_ret: RnaSeqReads):
     )
 
 
+@Helper
+def read_fastq(path, *, batch_size=100_000, chunk_size=1 << 24):
+    """Yield the (names, sequences, qualities) of the reads in a (gzipped)
+    FASTQ file in batches of batch_size, decompressing it chunk_size bytes at
+    a time"""
+
+    opener = gzip.open if path.endswith(".gz") else open
+    lines = []
+    with opener(path, "rb") as f:
+        rest = b""
+        while chunk := f.read(chunk_size):
+            lines += (rest + chunk).split(b"\n")
+            rest = lines.pop()
+            while len(lines) >= 4 * batch_size:
+                batch, lines = lines[: 4 * batch_size], lines[4 * batch_size :]
+                yield batch[0::4], batch[1::4], batch[3::4]
+    lines += [line for line in rest.split(b"\n") if line]
+    end = len(lines) // 4 * 4
+    if end > 0:
+        yield lines[0:end:4], lines[1:end:4], lines[3:end:4]
+
+
+@Helper
+class FastqStats:
+    """Streaming statistics of a FASTQ file, computed with NumPy over batches
+    of reads: per-position quality, GC content, read length, and adapter
+    content"""
+
+    MAX_QUALITY = 60
+
+    # 12-mers of the adapters that FastQC checks for by default
+    ADAPTERS = {
+        "Illumina Universal Adapter": b"AGATCGGAAGAG",
+        "Illumina Small RNA 3' Adapter": b"TGGAATTCTCGG",
+        "Nextera Transposase Sequence": b"CTGTCTCTTATA",
+        "PolyA": b"AAAAAAAAAAAA",
+    }
+
+    def __init__(self):
+        self.reads = 0
+        self.bases = 0
+        # quality[position, score] = number of bases
+        self.quality = np.zeros((0, self.MAX_QUALITY + 1), dtype=np.int64)
+        # lengths[length] = number of reads
+        self.lengths = np.zeros(0, dtype=np.int64)
+        # gc[percent] = number of reads
+        self.gc = np.zeros(101, dtype=np.int64)
+        # adapters[name][position] = number of reads where adapter starts
+        self.adapters = {name: np.zeros(0, dtype=np.int64) for name in self.ADAPTERS}
+
+    @staticmethod
+    def _add(a, b):
+        if len(b) > len(a):
+            a, b = b, a
+        a = a.copy()
+        a[: len(b)] += b
+        return a
+
+    def merge(self, other):
+        self.reads += other.reads
+        self.bases += other.bases
+        self.quality = self._add(self.quality, other.quality)
+        self.lengths = self._add(self.lengths, other.lengths)
+        self.gc += other.gc
+        for name in self.adapters:
+            self.adapters[name] = self._add(self.adapters[name], other.adapters[name])
+        return self
+
+    def add_batch(self, sequences, qualities):
+        lengths = np.fromiter(map(len, sequences), dtype=np.int64)
+        starts = np.cumsum(lengths) - lengths
+        seq = np.frombuffer(b"".join(sequences), dtype=np.uint8)
+        qual = np.frombuffer(b"".join(qualities), dtype=np.uint8)
+        if len(qual) != len(seq):
+            raise ValueError("Sequence and quality lengths differ")
+
+        # Position of each base within its read
+        position = np.arange(len(seq)) - np.repeat(starts, lengths)
+        width = self.MAX_QUALITY + 1
+        max_length = int(lengths.max(initial=0))
+
+        score = np.clip(qual.astype(np.int64) - 33, 0, self.MAX_QUALITY)
+        quality = np.bincount(
+            position * width + score,
+            minlength=max_length * width,
+        ).reshape(max_length, width)
+
+        is_gc = (seq == ord("G")) | (seq == ord("C"))
+        cumulative_gc = np.concatenate([[0], np.cumsum(is_gc)])
+        gc = cumulative_gc[starts + lengths] - cumulative_gc[starts]
+        gc_percent = 100 * gc // np.maximum(lengths, 1)
+
+        self.reads += len(lengths)
+        self.bases += len(seq)
+        self.quality = self._add(self.quality, quality)
+        self.lengths = self._add(self.lengths, np.bincount(lengths))
+        self.gc += np.bincount(gc_percent, minlength=101)
+
+        for name, adapter in self.ADAPTERS.items():
+            k = len(adapter)
+            n = len(seq) - k + 1
+            if n <= 0:
+                continue
+            match = seq[:n] == adapter[0]
+            for i in range(1, k):
+                match &= seq[i : n + i] == adapter[i]
+            index = np.flatnonzero(match)
+            read = np.searchsorted(starts, index, side="right") - 1
+            offset = index - starts[read]
+            # Matches spanning two reads do not count
+            within = offset + k <= lengths[read]
+            # First match in each read (matches are in order)
+            _, first = np.unique(read[within], return_index=True)
+            self.adapters[name] = self._add(
+                self.adapters[name],
+                np.bincount(offset[within][first]),
+            )
+
+    @classmethod
+    def of_file(cls, path):
+        stats = cls()
+        for _, sequences, qualities in read_fastq(path):
+            stats.add_batch(sequences, qualities)
+        return stats
+
+    def summary(self):
+        positions = self.quality.sum(axis=1)
+        scores = np.arange(self.MAX_QUALITY + 1)
+        mean_quality = (self.quality @ scores) / np.maximum(positions, 1)
+        return {
+            "reads": self.reads,
+            "bases": self.bases,
+            "mean_length": self.bases / max(self.reads, 1),
+            "mean_quality": float(self.quality.sum(axis=0) @ scores)
+            / max(self.bases, 1),
+            "mean_gc_percent": float(self.gc @ np.arange(101)) / max(self.reads, 1),
+            "per_position_mean_quality": mean_quality.round(2).tolist(),
+            "length_distribution": self.lengths.tolist(),
+            "gc_distribution": self.gc.tolist(),
+            # Percentage of reads with the adapter by each position (as FastQC)
+            "adapter_content": {
+                name: (100 * np.cumsum(counts) / max(self.reads, 1)).round(3).tolist()
+                for name, counts in self.adapters.items()
+            },
+        }
+
+
+@Helper
+def fastq_report(paths, output, *, jobs):
+    """Compute FastqStats for each FASTQ file (at most jobs files at a time)
+    and write one aggregated report to output.json and output.html"""
+
+    with worker_pool(jobs) as pool:
+        all_stats = pool.map(FastqStats.of_file, paths)
+
+    write_fastq_report(
+        {os.path.basename(path): stats for path, stats in zip(paths, all_stats)},
+        output,
+    )
+
+
+@Helper
+def write_fastq_report(all_stats, output):
+    """Write the FastqStats for each file (by name) and their total to
+    output.json and output.html"""
+
+    total = FastqStats()
+    for stats in all_stats.values():
+        total.merge(stats)
+
+    report = {
+        "files": {name: stats.summary() for name, stats in all_stats.items()},
+        "total": total.summary(),
+    }
+
+    with open(output + ".json", "w") as f:
+        json.dump(report, f)
+
+    rows = ""
+    for name, summary in [*report["files"].items(), ("Total", report["total"])]:
+        adapter = max(
+            (content[-1] for content in summary["adapter_content"].values() if content),
+            default=0,
+        )
+        rows += (
+            f"<tr><td>{name}</td><td>{summary['reads']:,}</td>"
+            f"<td>{summary['mean_length']:.1f}</td>"
+            f"<td>{summary['mean_quality']:.1f}</td>"
+            f"<td>{summary['mean_gc_percent']:.1f}</td>"
+            f"<td>{adapter:.2f}</td></tr>\n"
+        )
+
+    with open(output + ".html", "w") as f:
+        f.write(
+            "<!DOCTYPE html>\n<title>FASTQ statistics</title>\n"
+            "<table>\n<tr><th>File</th><th>Reads</th><th>Mean length</th>"
+            "<th>Mean quality</th><th>GC (%)</th><th>Max adapter (%)</th></tr>\n"
+            f"{rows}</table>\n"
+            f"<p>Per-position details are in {os.path.basename(output)}.json</p>\n"
+        )
+
+
+@Helper
+def padded(sequences):
+    """The reads of a batch as a (reads x max length) matrix padded with zeros,
+    along with their lengths"""
+
+    lengths = np.fromiter(map(len, sequences), dtype=np.int64)
+    matrix = np.zeros((len(sequences), lengths.max(initial=0)), dtype=np.uint8)
+    matrix[np.arange(matrix.shape[1]) < lengths[:, None]] = np.frombuffer(
+        b"".join(sequences), dtype=np.uint8
+    )
+    return matrix, lengths
+
+
+@Helper
+def adapter_start(sequences, adapter, *, min_overlap=3):
+    """Where the 3' adapter starts in each read (or the read length if absent)
+
+    The adapter must match exactly, but may run off the end of the read if at
+    least min_overlap bases of it are present."""
+
+    matrix, lengths = padded(sequences)
+    width = matrix.shape[1]
+    position = np.arange(width)
+    # match[r, p]: the adapter is present in read r starting at p
+    match = position < lengths[:, None] - min_overlap + 1
+    for j, base in enumerate(adapter[:width]):
+        match[:, : width - j] &= (matrix[:, j:] == base) | (
+            position[j:] >= lengths[:, None]
+        )
+    return np.where(match.any(axis=1), match.argmax(axis=1), lengths)
+
+
+@Helper
+def poly_a_start(sequences, *, base=b"A", min_length=3):
+    """Where the poly-A tail starts in each read (or the read length if absent)
+
+    Like cutadapt, tails are scored with +1 for each A and -2 for anything
+    else, so they may contain a few errors (at most 20%)."""
+
+    matrix, lengths = padded(sequences)
+    is_base = matrix == base[0]
+    in_read = np.arange(matrix.shape[1]) < lengths[:, None]
+    score = np.where(is_base, 1, -2) * in_read
+    errors = ~is_base & in_read
+    # suffix[r, p]: score of read r's tail starting at p (and so on)
+    suffix = np.cumsum(score[:, ::-1], axis=1)[:, ::-1]
+    suffix_errors = np.cumsum(errors[:, ::-1], axis=1)[:, ::-1]
+    tail_length = lengths[:, None] - np.arange(matrix.shape[1])
+    suffix[(5 * suffix_errors > tail_length) | ~in_read] = 0
+    # Shortest best-scoring tail
+    start = matrix.shape[1] - 1 - suffix[:, ::-1].argmax(axis=1)
+    best = suffix[np.arange(len(lengths)), start]
+    trim = (best > 0) & (lengths - start >= min_length)
+    return np.where(trim, start, lengths)
+
+
+@Helper
+def trim_fastq_pair(paths, outputs, *, adapters):
+    """Trim 3' adapters (with adapters[0] and adapters[1]), then poly-A tails
+    from the forward reads and poly-T heads from the reverse reads, of a pair
+    of FASTQ files, discarding pairs where either read is trimmed away
+
+    Returns the FastqStats of the forward and reverse reads before and after
+    trimming, collected in the same pass."""
+
+    before = [FastqStats(), FastqStats()]
+    after = [FastqStats(), FastqStats()]
+
+    forward, reverse = (read_fastq(path) for path in paths)
+    with (
+        gzip.open(outputs[0], "wb", compresslevel=1) as out1,
+        gzip.open(outputs[1], "wb", compresslevel=1) as out2,
+    ):
+        for batch1, batch2 in zip(forward, reverse, strict=True):
+            (names1, seqs1, quals1), (names2, seqs2, quals2) = batch1, batch2
+            if len(seqs1) != len(seqs2):
+                raise ValueError(f"Different numbers of reads in {paths}")
+            before[0].add_batch(seqs1, quals1)
+            before[1].add_batch(seqs2, quals2)
+
+            # Forward reads: adapter, then poly-A tail
+            end1 = adapter_start(seqs1, adapters[0])
+            seqs1 = [s[:e] for s, e in zip(seqs1, end1)]
+            end1 = poly_a_start(seqs1)
+
+            # Reverse reads: adapter, then poly-T head (reverse complement of
+            # the forward read's poly-A tail)
+            end2 = adapter_start(seqs2, adapters[1])
+            seqs2 = [s[:e] for s, e in zip(seqs2, end2)]
+            start2 = np.array([len(s) for s in seqs2]) - poly_a_start(
+                [s[::-1] for s in seqs2], base=b"T"
+            )
+
+            keep = np.flatnonzero((end1 > 0) & (end2 - start2 > 0))
+            seqs1 = [seqs1[i][: end1[i]] for i in keep]
+            quals1 = [quals1[i][: end1[i]] for i in keep]
+            seqs2 = [seqs2[i][start2[i] :] for i in keep]
+            quals2 = [quals2[i][start2[i] : end2[i]] for i in keep]
+            after[0].add_batch(seqs1, quals1)
+            after[1].add_batch(seqs2, quals2)
+
+            for out, names, seqs, quals in [
+                (out1, [names1[i] for i in keep], seqs1, quals1),
+                (out2, [names2[i] for i in keep], seqs2, quals2),
+            ]:
+                out.write(
+                    b"".join(
+                        b"%s\n%s\n+\n%s\n" % record
+                        for record in zip(names, seqs, quals)
+                    )
+                )
+
+    return before, after
+
+
+@Function(
+    "ret.trimmed = reads.trimmed",
+    "ret.qc = true",
+    "reads.qc = false",
+    use="a fast, built-in alternative to FastQC and MultiQC that reads each file once.",
+)
+def fastq_stats(__hb_reads: RnaSeqReads, __hb_ret: RnaSeqReads):
+    """FASTQ statistics
+
+    # Run quality control checks on RNA-seq data in a single pass
+
+    This step computes the per-position base quality, GC content, read length
+    distribution, and adapter content (the core FastQC metrics) of every
+    forward and reverse read file in parallel, then aggregates them into a
+    single report (fastq_stats.html, with full details in fastq_stats.json).
+
+    The Harvard Chan Bioinformatics Core provides a
+    [useful tutorial](https://hbctraining.github.io/Intro-to-rnaseq-hpc-salmon/lessons/qc_fastqc_assessment.html#assessing-quality-metrics)
+    for assessing these metrics."""
+
+    # PARAMETER: The number of files that you want to process at the same time
+    FASTQ_STATS_JOBS = 4
+
+    carry_over(__hb_reads, __hb_ret)
+
+    fastqs = SampleSheet(__hb_reads.path, index_dir=__hb_ret.path).all_fastqs()
+
+    fastq_report(fastqs, f"{__hb_ret.path}/fastq_stats", jobs=FASTQ_STATS_JOBS)
+
+
+@Function(
+    "reads.trimmed = false",
+    "ret.trimmed = true",
+    "ret.qc = true",
+    use="a fast, built-in alternative to running FastQC, cutadapt, and FastQC "
+    "again that reads each file once.",
+)
+def trim_and_qc(__hb_reads: RnaSeqReads, __hb_ret: RnaSeqReads):
+    """Trim + QC (single pass)
+
+    # Remove Illumina universal adapters and poly(A) tails, with quality control checks before and after, in a single pass
+
+    This step trims the same adapter sequences and poly(A) tails as the
+    cutadapt (Illumina) step while computing the per-position base quality,
+    GC content, read length distribution, and adapter content of every read
+    file before and after trimming. Each file is read only once.
+
+    Unlike cutadapt, adapters must match exactly (though they may be cut off
+    by the end of the read).
+
+    The reports are in fastq_stats_untrimmed.html and fastq_stats.html (with
+    full details in the corresponding .json files)."""
+
+    # PARAMETER: The number of samples that you want to process at the same time
+    TRIM_AND_QC_JOBS = 4
+
+    carry_over(__hb_reads, __hb_ret, file="sample_sheet.csv")
+
+    sample_sheet = SampleSheet(__hb_reads.path)
+
+    with worker_pool(TRIM_AND_QC_JOBS) as pool:
+        futures = {
+            sample_name: pool.submit(
+                trim_fastq_pair,
+                sample_sheet.fastqs(sample_name),
+                [f"{__hb_ret.path}/{sample_name}_{read}.fastq.gz" for read in [1, 2]],
+                adapters=[
+                    b"AGATCGGAAGAGCACACGTCTGAACTCCAGTCA",
+                    b"AGATCGGAAGAGCGTCGTGTAGGGAAAGAGTGT",
+                ],
+            )
+            for sample_name in sample_sheet.sample_names
+        }
+        results = {
+            sample_name: future.result() for sample_name, future in futures.items()
+        }
+
+    for output, index in [("fastq_stats_untrimmed", 0), ("fastq_stats", 1)]:
+        write_fastq_report(
+            {
+                f"{sample_name}_{read + 1}.fastq.gz": stats[index][read]
+                for sample_name, stats in results.items()
+                for read in [0, 1]
+            },
+            f"{__hb_ret.path}/{output}",
+        )
+
+
 @Function(
     "reads.qc = true",
     "ret.qc = false",
@@ -296,21 +1160,38 @@ def cutadapt_illumina(__hb_reads: RnaSeqReads, __hb_ret: RnaSeqReads):
     > Cutadapt helps with these trimming tasks by finding the adapter or primer
     > sequences in an error-tolerant way."""
 
+    # PARAMETER: The number of cores that you want cutadapt to use (in total)
+    CUTADAPT_CORES = 4
+
+    # PARAMETER: The number of samples to trim at the same time
+    CUTADAPT_CONCURRENT_SAMPLES = 2
+
     carry_over(__hb_reads, __hb_ret, file="sample_sheet.csv")
 
-    sample_sheet = pl.read_csv(f"{__hb_reads.path}/sample_sheet.csv")
+    sample_sheet = SampleSheet(__hb_reads.path)
 
-    for sample_name in sample_sheet["sample_name"]:
-        __hb_bash(f"""uv run cutadapt \\
-                    --cores=0 \\
+    # Split the cores between the samples trimmed at the same time
+    cores = max(1, CUTADAPT_CORES // CUTADAPT_CONCURRENT_SAMPLES)
+
+    def trim(sample_name):
+        fastq_1, fastq_2 = sample_sheet.fastqs(sample_name)
+        return f"""uv run cutadapt \\
+                    --cores={cores} \\
                     -m 1 \\
                     --poly-a \\
                     -a AGATCGGAAGAGCACACGTCTGAACTCCAGTCA \\
                     -A AGATCGGAAGAGCGTCGTGTAGGGAAAGAGTGT \\
                     -o {__hb_ret.path}/{sample_name}_1.fastq.gz \\
                     -p {__hb_ret.path}/{sample_name}_2.fastq.gz \\
-                    {__hb_reads.path}/{sample_name}_1.fastq.gz \\
-                    {__hb_reads.path}/{sample_name}_2.fastq.gz""")
+                    {fastq_1} \\
+                    {fastq_2}"""
+
+    for_each_sample(
+        sample_sheet.sample_names,
+        trim,
+        jobs=CUTADAPT_CONCURRENT_SAMPLES,
+        log_dir=f"{__hb_ret.path}/logs",
+    )
 
 
 ################################################################################
@@ -353,20 +1234,34 @@ def kallisto(__hb_reads: RnaSeqReads, __hb_ret: TranscriptMatrices):
     # PARAMETER: The location of the kallisto transcriptome index on your computer
     KALLISTO_INDEX = "ensembl115.Homo_sapiens.GRCh38.cdna.all.kallisto.idx"
 
-    # PARAMETER: The number of cores that you want kallisto to use
+    # PARAMETER: The number of cores that you want kallisto to use (in total)
     KALLISTO_CORES = 4
 
+    # PARAMETER: The number of samples to quantify at the same time
+    KALLISTO_CONCURRENT_SAMPLES = 2
+
     carry_over(__hb_reads, __hb_ret, file="sample_sheet.csv")
 
-    sample_sheet = pl.read_csv(f"{__hb_reads.path}/sample_sheet.csv")
+    sample_sheet = SampleSheet(__hb_reads.path)
 
-    for sample_name in sample_sheet["sample_name"]:
-        __hb_bash(f"""kallisto quant \\
-                    -t {KALLISTO_CORES} \\
+    # Split the cores between the samples quantified at the same time
+    threads = max(1, KALLISTO_CORES // KALLISTO_CONCURRENT_SAMPLES)
+
+    def quantify(sample_name):
+        fastq_1, fastq_2 = sample_sheet.fastqs(sample_name)
+        return f"""kallisto quant \\
+                    -t {threads} \\
                     -i {KALLISTO_INDEX} \\
                     -o {__hb_ret.path}/{sample_name} \\
-                    {__hb_reads.path}/{sample_name}_1.fastq.gz \\
-                    {__hb_reads.path}/{sample_name}_2.fastq.gz""")
+                    {fastq_1} \\
+                    {fastq_2}"""
+
+    for_each_sample(
+        sample_sheet.sample_names,
+        quantify,
+        jobs=KALLISTO_CONCURRENT_SAMPLES,
+        log_dir=f"{__hb_ret.path}/logs",
+    )
 
 
 ################################################################################
@@ -432,17 +1327,87 @@ def tximport(__hb_data: TranscriptMatrices, __hb_ret: GeneMatrices):
     # PARAMETER: The Ensembl gene annotation dataset to use
     ENSEMBL_DATASET = "hsapiens_gene_ensembl"
 
+    # PARAMETER: The Ensembl BioMart to download annotations from (it must serve ENSEMBL_VERSION)
+    ENSEMBL_BIOMART_URL = "https://www.ensembl.org/biomart/martservice"
+
+    # PARAMETER: The local store of Ensembl annotations (see environment/prefetch_ensembl.py)
+    ENSEMBL_CACHE_DIR = "~/.cache/honeybee/ensembl"
+
     carry_over(__hb_data, __hb_ret, file="sample_sheet.csv")
 
+    EnsemblAnnotations(
+        ENSEMBL_CACHE_DIR,
+        dataset=ENSEMBL_DATASET,
+        version=ENSEMBL_VERSION,
+        url=ENSEMBL_BIOMART_URL,
+    ).write_csv("tx2gene", f"{__hb_ret.path}/tx2gene.csv")
+
     __hb_bash(f"""
         Rscript tximport.r \\
-            {ENSEMBL_VERSION} \\
-            {ENSEMBL_DATASET} \\
+            {__hb_ret.path}/tx2gene.csv \\
             {__hb_data.path}/sample_sheet.csv \\
             {__hb_data.path} \\
             {__hb_ret.path}""")
 
 
+@Function(
+    google_scholar_id="5898741618830664005",
+    pmid="26925227",
+    citation="Soneson C, Love MI, Robinson MD (2015). Differential analyses "
+    "for RNA-seq: transcript-level estimates improve gene-level inferences. "
+    "F1000Research, 4. doi:10.12688/f1000research.7563.1.",
+    use="a fast, built-in reimplementation of tximport that caches its gene "
+    "annotations.",
+)
+def tximport_native(__hb_data: TranscriptMatrices, __hb_ret: GeneMatrices):
+    """tximport (native)
+
+    # Aggregate transcript-level estimated counts for gene-level analysis (like [tximport](https://bioconductor.org/packages/release/bioc/html/tximport.html), without R)
+
+    Tools like [kallisto](https://pachterlab.github.io/kallisto/) report
+    transcript-level read counts, but many analyses of interest (such as
+    differential _gene_ expression) require gene-level data. This step sums the
+    estimated counts and TPM abundances of the transcripts of each gene, as
+    tximport does, producing the same counts.csv and abundance.csv files.
+
+    The transcript-to-gene mapping is downloaded from Ensembl once and then
+    reused from a local cache."""
+
+    # PARAMETER: The version of Ensembl to use for gene annotations
+    ENSEMBL_VERSION = "115"
+
+    # PARAMETER: The Ensembl gene annotation dataset to use
+    ENSEMBL_DATASET = "hsapiens_gene_ensembl"
+
+    # PARAMETER: The Ensembl BioMart to download annotations from (it must serve ENSEMBL_VERSION)
+    ENSEMBL_BIOMART_URL = "https://www.ensembl.org/biomart/martservice"
+
+    # PARAMETER: The local store of Ensembl annotations (see environment/prefetch_ensembl.py)
+    ENSEMBL_CACHE_DIR = "~/.cache/honeybee/ensembl"
+
+    carry_over(__hb_data, __hb_ret, file="sample_sheet.csv")
+
+    sample_sheet = pl.read_csv(f"{__hb_data.path}/sample_sheet.csv")
+
+    annotations = EnsemblAnnotations(
+        ENSEMBL_CACHE_DIR,
+        dataset=ENSEMBL_DATASET,
+        version=ENSEMBL_VERSION,
+        url=ENSEMBL_BIOMART_URL,
+    )
+
+    counts, abundance = aggregate_transcripts(
+        {
+            sample_name: f"{__hb_data.path}/{sample_name}/abundance.tsv"
+            for sample_name in sample_sheet["sample_name"]
+        },
+        annotations.path("tx2gene"),
+    )
+
+    counts.write_csv(f"{__hb_ret.path}/counts.csv")
+    abundance.write_csv(f"{__hb_ret.path}/abundance.csv")
+
+
 ################################################################################
 # %% Differential Gene Expression
 
@@ -510,18 +1475,605 @@ def deseq2(__hb_data: GeneMatrices, __hb_ret: DifferentialGeneExpression):
     # PARAMETER: The Ensembl gene annotation dataset to use
     ENSEMBL_DATASET = "hsapiens_gene_ensembl"
 
+    # PARAMETER: The Ensembl BioMart to download annotations from (it must serve ENSEMBL_VERSION)
+    ENSEMBL_BIOMART_URL = "https://www.ensembl.org/biomart/martservice"
+
+    # PARAMETER: The local store of Ensembl annotations (see environment/prefetch_ensembl.py)
+    ENSEMBL_CACHE_DIR = "~/.cache/honeybee/ensembl"
+
     carry_over(__hb_data, __hb_ret, file="sample_sheet.csv")
 
+    EnsemblAnnotations(
+        ENSEMBL_CACHE_DIR,
+        dataset=ENSEMBL_DATASET,
+        version=ENSEMBL_VERSION,
+        url=ENSEMBL_BIOMART_URL,
+    ).write_csv("gene_metadata", f"{__hb_ret.path}/gene_metadata.csv")
+
     __hb_bash(f"""
         Rscript deseq2.r \\
-            {ENSEMBL_VERSION} \\
-            {ENSEMBL_DATASET} \\
+            {__hb_ret.path}/gene_metadata.csv \\
             {__hb_data.path}/sample_sheet.csv \\
             {__hb_ret.comparison_sheet} \\
             {__hb_data.path}/counts.csv \\
             {__hb_ret.path}""")
 
 
+@Helper
+def lgamma(x):
+    """Logarithm of the gamma function (for positive arrays)"""
+
+    # Shift small arguments up (lgamma(x) = lgamma(x + 6) - log(x ... (x + 5)))
+    # so that Stirling's series is accurate
+    small = np.minimum(x, 6)
+    shift = np.where(
+        x < 6,
+        np.log(small * (small + 1) * (small + 2) * (small + 3) * (small + 4))
+        + np.log(small + 5),
+        0,
+    )
+    z = np.where(x < 6, x + 6, x)
+    return (
+        (z - 0.5) * np.log(z)
+        - z
+        + 0.5 * np.log(2 * np.pi)
+        + 1 / (12 * z)
+        - 1 / (360 * z**3)
+        + 1 / (1260 * z**5)
+        - shift
+    )
+
+
+@Helper
+def digamma(x):
+    """Digamma function (for positive arrays)"""
+
+    shift = np.zeros_like(x, dtype=float)
+    z = np.array(x, dtype=float)
+    for _ in range(6):
+        small = z < 6
+        shift += np.where(small, 1 / z, 0)
+        z += small
+    return (
+        np.log(z) - 1 / (2 * z) - 1 / (12 * z**2) + 1 / (120 * z**4) - 1 / (252 * z**6)
+    ) - shift
+
+
+@Helper
+def trigamma(x):
+    """Trigamma function (for positive arrays)"""
+
+    shift = np.zeros_like(x, dtype=float)
+    z = np.array(x, dtype=float)
+    for _ in range(6):
+        small = z < 6
+        shift += np.where(small, 1 / z**2, 0)
+        z += small
+    return (
+        1 / z + 1 / (2 * z**2) + 1 / (6 * z**3) - 1 / (30 * z**5) + 1 / (42 * z**7)
+    ) + shift
+
+
+@Helper
+def erfc(x):
+    """Complementary error function (with relative error below 1.2e-7)"""
+
+    t = 1 / (1 + 0.5 * np.abs(x))
+    coefficients = [
+        -1.26551223,
+        1.00002368,
+        0.37409196,
+        0.09678418,
+        -0.18628806,
+        0.27886807,
+        -1.13520398,
+        1.48851587,
+        -0.82215223,
+        0.17087277,
+    ]
+    polynomial = 0
+    for coefficient in reversed(coefficients):
+        polynomial = coefficient + t * polynomial
+    y = t * np.exp(-(x**2) + polynomial)
+    return np.where(x < 0, 2 - y, y)
+
+
+@Helper
+def size_factors(counts):
+    """DESeq2's median-of-ratios size factors of a (genes x samples) count
+    matrix"""
+
+    log_counts = np.log(counts[(counts > 0).all(axis=1)])
+    if len(log_counts) == 0:
+        raise ValueError("Every gene has a zero count in some sample")
+    log_ratios = log_counts - log_counts.mean(axis=1, keepdims=True)
+    return np.exp(np.median(log_ratios, axis=0))
+
+
+@Helper
+def is_group_design(design):
+    """Whether a design matrix puts each sample (row) in exactly one group
+    (column), so that X^T W X is diagonal"""
+
+    return bool(np.isin(design, [0, 1]).all() and (design.sum(axis=1) == 1).all())
+
+
+@Helper
+def fit_nb_glm(counts, design, size_factors, dispersions, *, iterations=100):
+    """Fit a negative binomial GLM (with a log link) to each gene (row) of
+    counts at once by iteratively reweighted least squares, returning the
+    (natural log) coefficients and their covariance matrices"""
+
+    log_size_factors = np.log(size_factors)
+    alpha = dispersions[:, None]
+    ridge = 1e-6 * np.eye(design.shape[1])
+    groups = is_group_design(design)
+
+    beta = np.linalg.lstsq(design, np.log(counts / size_factors + 0.1).T)[0].T
+    for _ in range(iterations):
+        # Means are bounded below (as in DESeq2) so that zeros stay finite
+        mu = np.maximum(np.exp(beta @ design.T + log_size_factors), 0.5)
+        weights = mu / (1 + alpha * mu)
+        working = np.log(mu) - log_size_factors + (counts - mu) / mu
+        previous = beta
+        if groups:
+            beta = (weights * working) @ design / (weights @ design + 1e-6)
+        else:
+            information = (design.T * weights[:, None, :]) @ design + ridge
+            beta = np.linalg.solve(
+                information, ((design.T * weights[:, None, :]) @ working[:, :, None])
+            )[:, :, 0]
+        beta = np.clip(beta, -30, 30)
+        if np.abs(beta - previous).max(initial=0) < 1e-8:
+            break
+
+    mu = np.maximum(np.exp(beta @ design.T + log_size_factors), 0.5)
+    weights = mu / (1 + alpha * mu)
+    if groups:
+        covariance = np.zeros((len(beta), design.shape[1], design.shape[1]))
+        diagonal = np.arange(design.shape[1])
+        covariance[:, diagonal, diagonal] = 1 / (weights @ design + 1e-6)
+        return beta, covariance
+    information = (design.T * weights[:, None, :]) @ design + ridge
+    return beta, np.linalg.inv(information)
+
+
+@Helper
+def fit_dispersions(counts, mu, design, log_alpha, *, bounds, prior=None):
+    """Maximize the Cox-Reid adjusted likelihood of the (log) dispersion of
+    each gene (row) of counts given its fitted means mu, by Newton's method
+    with backtracking, optionally with a normal prior (means, variance) on the
+    log dispersions"""
+
+    groups = is_group_design(design)
+
+    def objective(genes, a, derivatives):
+        y, m = counts[genes], mu[genes]
+        alpha = np.exp(a)[:, None]
+        r = 1 / alpha
+        weights = m / (1 + alpha * m)
+        if groups:
+            information = weights @ design
+            log_determinant = np.log(information).sum(axis=1)
+        else:
+            information = (design.T * weights[:, None, :]) @ design
+            log_determinant = np.linalg.slogdet(information)[1]
+        value = (
+            lgamma(y + r) - lgamma(r) - r * np.log1p(alpha * m) - y * np.log(r + m)
+        ).sum(axis=1) - 0.5 * log_determinant
+        if prior is not None:
+            value -= (a - prior[0][genes]) ** 2 / (2 * prior[1])
+        if not derivatives:
+            return value
+
+        # Derivatives of the likelihood in r = 1 / alpha, then in log alpha
+        d_r = (
+            digamma(y + r) - digamma(r) - np.log1p(alpha * m) + (m - y) / (r + m)
+        ).sum(axis=1)
+        d2_r = (
+            trigamma(y + r) - trigamma(r) + 1 / r - 2 / (r + m) + (y + r) / (r + m) ** 2
+        ).sum(axis=1)
+        r = r[:, 0]
+        gradient = -r * d_r
+        hessian = r * d_r + r**2 * d2_r
+
+        # Cox-Reid adjustment (its small second derivative is left out)
+        d_weights = -alpha * weights**2
+        if groups:
+            trace = (d_weights @ design / information).sum(axis=1)
+        else:
+            d_information = (design.T * d_weights[:, None, :]) @ design
+            trace = np.trace(
+                np.linalg.solve(information, d_information), axis1=1, axis2=2
+            )
+        gradient -= 0.5 * trace
+
+        if prior is not None:
+            gradient -= (a - prior[0][genes]) / prior[1]
+            hessian -= 1 / prior[1]
+        return value, gradient, hessian
+
+    a = np.clip(log_alpha, *bounds)
+    active = np.arange(len(a))
+
+    # Without a prior the likelihood can be nearly flat far from its maximum,
+    # so start from the best of log_alpha and a coarse grid
+    if prior is None:
+        best = objective(active, a, False)
+        for point in np.linspace(*bounds, 12):
+            value = objective(active, np.full(len(a), point), False)
+            a = np.where(value > best, point, a)
+            best = np.maximum(value, best)
+
+    for _ in range(50):
+        value, gradient, hessian = objective(active, a[active], True)
+        step = np.where(
+            hessian < 0, -gradient / np.minimum(hessian, -1e-12), np.sign(gradient)
+        )
+        step = np.clip(step, -1, 1)
+
+        # Halve the steps that decrease the objective (dropping those that
+        # still do after 10 halvings)
+        updated_value = value.copy()
+        trying = np.arange(len(active))
+        for _ in range(10):
+            candidate = np.clip(a[active[trying]] + step[trying], *bounds)
+            candidate_value = objective(active[trying], candidate, False)
+            worse = candidate_value < value[trying]
+            updated_value[trying[~worse]] = candidate_value[~worse]
+            trying = trying[worse]
+            step[trying] /= 2
+            if len(trying) == 0:
+                break
+        step[trying] = 0
+
+        # Stop (like DESeq2) once the objective barely changes
+        updated = np.clip(a[active] + step, *bounds)
+        moved = np.abs(updated - a[active])
+        improved = updated_value - value > 1e-6 * (np.abs(value) + 0.1)
+        a[active] = updated
+        active = active[(moved >= 1e-6) & improved]
+        if len(active) == 0:
+            break
+    return a
+
+
+@Helper
+def linear_means(counts, design, size_factors):
+    """Fitted means of each gene by least squares on the normalized counts (as
+    DESeq2 does for designs of groups), bounded below by 0.5"""
+
+    normalized = counts / size_factors
+    fitted = normalized @ (design @ np.linalg.pinv(design)).T
+    return normalized, fitted, np.maximum(fitted * size_factors, 0.5)
+
+
+@Helper
+def gene_wise_dispersions(counts, design, size_factors, bounds):
+    """Maximum likelihood (log) dispersion of each gene (row) of counts"""
+
+    samples, coefficients = design.shape
+    normalized, fitted, mu = linear_means(counts, design, size_factors)
+
+    # Start from the smaller of DESeq2's rough and moments estimates
+    rough = ((normalized - fitted) ** 2 - fitted) / np.maximum(fitted, 1) ** 2
+    rough = rough.sum(axis=1) / (samples - coefficients)
+    mean = normalized.mean(axis=1)
+    moments = (
+        normalized.var(axis=1, ddof=1) - np.mean(1 / size_factors) * mean
+    ) / mean**2
+    start = np.log(np.clip(np.minimum(rough, moments), *np.exp(bounds)))
+
+    return fit_dispersions(counts, mu, design, start, bounds=bounds)
+
+
+@Helper
+def dispersion_trend(base_mean, dispersions):
+    """DESeq2's parametric trend (a + b / mean) of the dispersions of genes,
+    fit by a gamma-family GLM, or their mean if that trend does not fit"""
+
+    use = dispersions > 1e-6
+    x = np.column_stack([np.ones(use.sum()), 1 / base_mean[use]])
+    y = dispersions[use]
+
+    coefficients = np.array([0.1, 1.0])
+    for _ in range(10):
+        residuals = y / (x @ coefficients)
+        good = (residuals > 1e-4) & (residuals < 15)
+        fit = coefficients
+        for _ in range(25):
+            weights = 1 / (x[good] @ fit) ** 2
+            fit = np.linalg.solve(
+                (x[good].T * weights) @ x[good], (x[good].T * weights) @ y[good]
+            )
+            if (fit <= 0).any():
+                return np.full_like(base_mean, y.mean())
+        converged = np.sum(np.log(fit / coefficients) ** 2) < 1e-6
+        coefficients = fit
+        if converged:
+            break
+
+    return coefficients[0] + coefficients[1] / base_mean
+
+
+@Helper
+def nb_wald_block(
+    counts,
+    design,
+    size_factors,
+    contrasts,
+    *,
+    gene_wise,
+    trend,
+    prior_variance,
+    outlier_variance,
+    bounds,
+):
+    """Shrink the (log) dispersions of a block of genes from their gene-wise
+    estimates towards their trend, then refit and test each contrast (row of
+    contrasts), returning natural log fold changes and their standard errors
+    (genes x contrasts)"""
+
+    _, _, mu = linear_means(counts, design, size_factors)
+    log_alpha = fit_dispersions(
+        counts, mu, design, trend, bounds=bounds, prior=(trend, prior_variance)
+    )
+    # Dispersion outliers keep their own dispersion, as in DESeq2
+    outlier = gene_wise > trend + 2 * np.sqrt(outlier_variance)
+    log_alpha = np.where(outlier, gene_wise, log_alpha)
+
+    beta, covariance = fit_nb_glm(counts, design, size_factors, np.exp(log_alpha))
+    log_fold_change = beta @ contrasts.T
+    variance = np.einsum("kp,gpq,kq->gk", contrasts, covariance, contrasts)
+    return log_fold_change, np.sqrt(variance)
+
+
+@Helper
+def adjust_pvalues(pvalues):
+    """Benjamini-Hochberg adjusted p-values (ignoring missing p-values)"""
+
+    adjusted = np.full_like(pvalues, np.nan)
+    tested = np.flatnonzero(~np.isnan(pvalues))
+    order = tested[np.argsort(pvalues[tested])]
+    ranked = pvalues[order] * len(order) / np.arange(1, len(order) + 1)
+    adjusted[order] = np.minimum(np.minimum.accumulate(ranked[::-1])[::-1], 1)
+    return adjusted
+
+
+@Helper
+def nb_wald_test(counts, design, contrasts, *, jobs, block_size=1000):
+    """DESeq2-style Wald tests of contrasts (rows of coefficients of design)
+    on a (genes x samples) count matrix, fitting jobs blocks of genes at a
+    time
+
+    Returns the base mean of each gene and, for each contrast, a dictionary of
+    log2 fold changes, their standard errors, Wald statistics, p-values, and
+    adjusted p-values (genes with only zero counts are not tested)."""
+
+    samples, coefficients = design.shape
+    if samples <= coefficients:
+        raise ValueError("Not enough samples to estimate dispersions")
+
+    factors = size_factors(counts)
+    base_mean = (counts / factors).mean(axis=1)
+    bounds = (np.log(1e-8), np.log(max(10, samples)))
+
+    expressed = np.flatnonzero(base_mean > 0)
+    blocks = [
+        expressed[start : start + block_size]
+        for start in range(0, len(expressed), block_size)
+    ]
+
+    with worker_pool(jobs) as pool:
+        gene_wise = np.concatenate(
+            list(
+                pool.map(
+                    gene_wise_dispersions,
+                    [counts[block] for block in blocks],
+                    [design] * len(blocks),
+                    [factors] * len(blocks),
+                    [bounds] * len(blocks),
+                )
+            )
+        )
+
+        # The trend and the spread around it are shared by all genes
+        trend = np.log(dispersion_trend(base_mean[expressed], np.exp(gene_wise)))
+        use = gene_wise > np.log(1e-6)
+        residuals = (gene_wise - trend)[use]
+        observed = (1.4826 * np.median(np.abs(residuals - np.median(residuals)))) ** 2
+        prior_variance = max(
+            observed - trigamma(np.array((samples - coefficients) / 2)), 0.25
+        )
+
+        # Blocks of the expressed genes' estimates line up with blocks of genes
+        results = [
+            pool.submit(
+                nb_wald_block,
+                counts[block],
+                design,
+                factors,
+                contrasts,
+                gene_wise=gene_wise[start : start + block_size],
+                trend=trend[start : start + block_size],
+                prior_variance=prior_variance,
+                outlier_variance=observed,
+                bounds=bounds,
+            )
+            for start, block in zip(range(0, len(expressed), block_size), blocks)
+        ]
+        log_fold_change, standard_error = (
+            np.concatenate(parts)
+            for parts in zip(*(result.result() for result in results))
+        )
+
+    tests = []
+    for k in range(len(contrasts)):
+        lfc = np.full(len(counts), np.nan)
+        se = np.full(len(counts), np.nan)
+        lfc[expressed] = log_fold_change[:, k] / np.log(2)
+        se[expressed] = standard_error[:, k] / np.log(2)
+        stat = lfc / se
+        pvalue = erfc(np.abs(stat) / np.sqrt(2))
+        tests.append(
+            {
+                "log2FoldChange": lfc,
+                "lfcSE": se,
+                "stat": stat,
+                "pvalue": pvalue,
+                "padj": adjust_pvalues(pvalue),
+            }
+        )
+    return base_mean, tests
+
+
+@Helper
+def comparison_design(sample_conditions, comparisons):
+    """Design matrix (with one coefficient per condition) of samples in the
+    given conditions, and the contrast (treatment minus control) of each
+    (control, treatment) comparison"""
+
+    levels = sorted(set(sample_conditions))
+    missing = {c for pair in comparisons for c in pair} - set(levels)
+    if missing:
+        raise ValueError(f"No samples in conditions: {', '.join(sorted(missing))}")
+
+    design = np.array(
+        [[condition == level for level in levels] for condition in sample_conditions],
+        dtype=float,
+    )
+    contrasts = np.zeros((len(comparisons), len(levels)))
+    for k, (control, treatment) in enumerate(comparisons):
+        contrasts[k, levels.index(treatment)] += 1
+        contrasts[k, levels.index(control)] -= 1
+    return design, contrasts
+
+
+@Helper
+def read_gene_counts(path):
+    """The gene IDs, sample names, and (rounded) counts matrix of a gene
+    counts CSV file (as written by tximport)"""
+
+    table = pl.read_csv(path)
+    gene_ids = table.to_series(0).to_list()
+    counts = table.drop(table.columns[0])
+    return gene_ids, counts.columns, np.round(counts.to_numpy().astype(float))
+
+
+@Function(
+    google_scholar_id="16121678637925818947",
+    citation="Love MI, Huber W, Anders S (2014). Moderated estimation of fold change "
+    "and dispersion for RNA-seq data with DESeq2. Genome Biology, 15, 550. "
+    "doi:10.1186/s13059-014-0550-8.",
+    pmid="25516281",
+    use="a fast, built-in reimplementation of the DESeq2 Wald test that does "
+    "not need R.",
+)
+def deseq2_native(__hb_data: GeneMatrices, __hb_ret: DifferentialGeneExpression):
+    """DESeq2 (native)
+
+    # Find differentially-expressed protein-coding genes with a built-in version of [DESeq2](https://bioconductor.org/packages/release/bioc/html/DESeq2.html)'s Wald test
+
+    Like DESeq2, this step models the read counts of each gene with a
+    negative binomial distribution, normalizes samples by median-of-ratios
+    size factors, shrinks the dispersion of each gene towards a fitted trend,
+    and tests each comparison with a Wald test, adjusting _p_-values for
+    multiple testing with the Benjamini-Hochberg procedure. All genes are fit
+    at once (in blocks, several at a time) without R.
+
+    Unlike DESeq2, it does not filter genes with low counts before adjusting
+    _p_-values or flag count outliers, so its adjusted _p_-values are never
+    `NA` for tested genes.
+
+    With many comparisons, setting `DE_SHARED_FIT` fits one model to all
+    samples (estimating size factors and dispersions once) and tests every
+    comparison with it at once, writing each result as a Parquet file."""
+
+    # PARAMETER: The version of Ensembl to use for gene annotations
+    ENSEMBL_VERSION = "115"
+
+    # PARAMETER: The Ensembl gene annotation dataset to use
+    ENSEMBL_DATASET = "hsapiens_gene_ensembl"
+
+    # PARAMETER: The Ensembl BioMart to download annotations from (it must serve ENSEMBL_VERSION)
+    ENSEMBL_BIOMART_URL = "https://www.ensembl.org/biomart/martservice"
+
+    # PARAMETER: The local store of Ensembl annotations (see environment/prefetch_ensembl.py)
+    ENSEMBL_CACHE_DIR = "~/.cache/honeybee/ensembl"
+
+    # PARAMETER: The number of blocks of genes to fit at the same time
+    DE_JOBS = 4
+
+    # PARAMETER: Fit one model to all samples and test every comparison with it at once (writing Parquet files), instead of one model per comparison
+    DE_SHARED_FIT = False
+
+    carry_over(__hb_data, __hb_ret, file="sample_sheet.csv")
+
+    annotations = EnsemblAnnotations(
+        ENSEMBL_CACHE_DIR,
+        dataset=ENSEMBL_DATASET,
+        version=ENSEMBL_VERSION,
+        url=ENSEMBL_BIOMART_URL,
+    )
+    annotations.write_csv("gene_metadata", f"{__hb_ret.path}/gene_metadata.csv")
+
+    protein_coding = set(
+        pl.read_parquet(annotations.path("gene_metadata"))
+        .filter(pl.col("gene_biotype") == "protein_coding")["ensembl_gene_id_version"]
+        .to_list()
+    )
+
+    gene_ids, samples, counts = read_gene_counts(f"{__hb_data.path}/counts.csv")
+    keep = [gene_id in protein_coding for gene_id in gene_ids]
+    gene_ids = [gene_id for gene_id, kept in zip(gene_ids, keep) if kept]
+    counts = counts[keep]
+
+    conditions = dict(
+        pl.read_csv(f"{__hb_data.path}/sample_sheet.csv")
+        .select(pl.col("sample_name").cast(pl.String), "condition")
+        .iter_rows()
+    )
+    comparisons = (
+        pl.read_csv(__hb_ret.comparison_sheet)
+        .select("control_condition", "treatment_condition")
+        .rows()
+    )
+
+    if DE_SHARED_FIT:
+        columns = [i for i, sample in enumerate(samples) if sample in conditions]
+        design, contrasts = comparison_design(
+            [conditions[samples[i]] for i in columns], comparisons
+        )
+
+        base_mean, tests = nb_wald_test(
+            counts[:, columns], design, contrasts, jobs=DE_JOBS
+        )
+
+        for (control, treatment), test in zip(comparisons, tests):
+            pl.DataFrame({"gene_id": gene_ids, "baseMean": base_mean, **test}).fill_nan(
+                None
+            ).write_parquet(f"{__hb_ret.path}/{control}-{treatment}.parquet")
+
+    else:
+        for control, treatment in comparisons:
+            columns = [
+                i
+                for i, sample in enumerate(samples)
+                if conditions.get(sample) in [control, treatment]
+            ]
+            design, contrasts = comparison_design(
+                [conditions[samples[i]] for i in columns], [(control, treatment)]
+            )
+
+            base_mean, [test] = nb_wald_test(
+                counts[:, columns], design, contrasts, jobs=DE_JOBS
+            )
+
+            pl.DataFrame({"gene_id": gene_ids, "baseMean": base_mean, **test}).fill_nan(
+                None
+            ).write_csv(f"{__hb_ret.path}/{control}-{treatment}.csv")
+
+
 ################################################################################
 # %% Stubs
 
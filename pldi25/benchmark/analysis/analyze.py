@@ -1,20 +1,56 @@
-import sys
-
-if len(sys.argv) != 4:
-    print(
-        f"usage: uv run {sys.argv[0]} MAX_DURATION_SECONDS INPUT_TSV OUTPUT_DIR",
-        file=sys.stderr,
-    )
-    sys.exit(1)
+import argparse
+
+# The names of the figures, in the order they are numbered
+FIGURES = [
+    "fin",
+    "inf",
+    "scalability",
+    "speedup",
+    "any",
+    "naive-fin",
+    "naive-inf",
+    "naive-scalability",
+]
+
+parser = argparse.ArgumentParser(
+    description="Analyze benchmark results and render their figures"
+)
+parser.add_argument("max_duration", metavar="MAX_DURATION_SECONDS", type=int)
+parser.add_argument("input", metavar="INPUT_TSV")
+parser.add_argument("output_dir", metavar="OUTPUT_DIR")
+parser.add_argument(
+    "store_dir",
+    metavar="STORE_DIR",
+    nargs="?",
+    help="directory of the incremental store (default: analyze from scratch)",
+)
+parser.add_argument(
+    "--figures",
+    nargs="+",
+    metavar="NAME",
+    choices=FIGURES,
+    help=f"only render these figures (of: {', '.join(FIGURES)})",
+)
+parser.add_argument(
+    "--jobs",
+    type=int,
+    help="render this many figures at once (default: one per CPU)",
+)
+args = parser.parse_args()
 
 ################################################################################
 # % % Imports
 
 import lib
+import store
 
 import numpy as np
 import polars as pl
+import concurrent.futures
 import importlib
+import matplotlib
+import multiprocessing
+import os
 
 ################################################################################
 # % % Config and load
@@ -23,13 +59,22 @@ import importlib
 CHECK = True
 
 # The synthesis cutoff duration, in milliseconds
-MAX_DURATION_MS = int(sys.argv[1]) * 1000
+MAX_DURATION_MS = args.max_duration * 1000
 
 # The CSV to load the data from
-INPUT = sys.argv[2]
+INPUT = args.input
 
 # The directory to output to
-OUTPUT_DIR = sys.argv[3]
+OUTPUT_DIR = args.output_dir
+
+# The directory of the incremental store (None to analyze from scratch)
+STORE_DIR = args.store_dir
+
+# The figures to render
+RENDER = FIGURES if args.figures is None else args.figures
+
+# The number of figures to render at once
+RENDER_JOBS = min(args.jobs or os.cpu_count() or 1, len(RENDER))
 
 # The maximum breadth/depth for scalability analysis
 MAX_DEPTH = 10
@@ -51,57 +96,180 @@ TASKS = SUITES + ["entry_name"]
 # Key for sets of runs on same task with same particular solution (replicates)
 REPLICATES = TASKS + ["solution_name"]
 
-# Load metadata and data
-raw_data = pl.read_csv(INPUT, separator="\t")
-algorithm_metadata = pl.read_csv("algorithm_metadata.csv")
+# The aggregated frames kept by the incremental store
+FRAMES = ["data", "particulars"]
+
+# Inputs at least this large are aggregated by Polars' streaming engine (in
+# bounded memory)
+STREAMING_MIN_BYTES = 1 << 30
+
+# Start the rendering workers (with the non-interactive Agg backend) before
+# Polars starts its thread pool, which processes forked later cannot use
+if RENDER_JOBS > 1:
+    render_pool = concurrent.futures.ProcessPoolExecutor(
+        RENDER_JOBS,
+        mp_context=multiprocessing.get_context("fork"),
+        initializer=matplotlib.use,
+        initargs=("Agg",),
+    )
+    render_pool.submit(os.getpid).result()
+else:
+    render_pool = None
+
+# Load metadata and data lazily (in incremental mode, new_data are the rows
+# added to INPUT since the last run)
+if STORE_DIR is None:
+    incremental = None
+    raw_data = pl.scan_csv(INPUT, separator="\t")
+    new_data = raw_data
+else:
+    incremental = store.Store(STORE_DIR, code=[__file__, lib.__file__])
+    raw_data, new_data = incremental.ingest(INPUT)
+algorithm_metadata = pl.scan_csv("algorithm_metadata.csv")
 
 ################################################################################
 # % % Check and clean data
 
 # Check that completed and successful columns are identical (no unsolvable
 # problems)
-if CHECK:
-    assert (raw_data["completed"] == raw_data["success"]).all()
-
-print(
-    "note:",
-    raw_data.select(
-        pl.col("completed") & (pl.col("duration") > MAX_DURATION_MS)
-    )
-    .sum()
-    .item(),
-    "entries completed after time cutoff of",
-    MAX_DURATION_MS // 1000,
-    "seconds",
+consistent = new_data.select(
+    consistent=(pl.col("completed") == pl.col("success")).all()
 )
 
-raw_data = raw_data.drop("success").with_columns(
-    completed=pl.when(pl.col("duration") <= MAX_DURATION_MS)
-    .then(raw_data["completed"])
-    .otherwise(pl.lit(False))
+late = raw_data.select(
+    late=(pl.col("completed") & (pl.col("duration") > MAX_DURATION_MS)).sum()
 )
 
+
+def clean(raw_data):
+    return raw_data.drop("success").with_columns(
+        completed=pl.when(pl.col("duration") <= MAX_DURATION_MS)
+        .then(pl.col("completed"))
+        .otherwise(pl.lit(False))
+    )
+
+
+raw_data = clean(raw_data)
+new_data = clean(new_data)
+
 ################################################################################
 # % % Process data
 
-# Aggregate replicates
-data = raw_data.group_by(REPLICATES).agg(
-    duration=pl.col("duration").median() / 1000,
-    completed=pl.col("completed").all(),
-)
+
+# Aggregate replicates (the median is taken over the counts of each distinct
+# duration, which the streaming engine can compute in bounded memory, unlike a
+# median over all the rows)
+def aggregate_replicates(raw_data):
+    cum = pl.col("count").sort_by("duration").cum_sum()
+    total = pl.col("count").sum()
+    duration = pl.col("duration").sort()
+    return (
+        raw_data.group_by(REPLICATES + ["duration"])
+        .agg(count=pl.len(), completed=pl.col("completed").all())
+        .group_by(REPLICATES)
+        .agg(
+            duration=(
+                duration.filter(cum > (total - 1) // 2).first()
+                + duration.filter(cum > total // 2).first()
+            )
+            / 2
+            / 1000,
+            completed=pl.col("completed").all(),
+        )
+    )
+
 
 # Aggregate particulars
-particulars = (
-    data.filter(pl.col("solution_name") != ANY_TASK)
-    .group_by(TASKS)
-    .agg(
-        duration=pl.col("duration").median(),
-        completed=pl.col("completed").all(),
+def aggregate_particulars(data):
+    return (
+        data.filter(pl.col("solution_name") != ANY_TASK)
+        .group_by(TASKS)
+        .agg(
+            duration=pl.col("duration").median(),
+            completed=pl.col("completed").all(),
+        )
     )
+
+
+# Compute scalability-specific columns
+def scalability_columns(particulars):
+    return (
+        particulars.filter(pl.col("suite_name") == "scal")
+        .with_columns(
+            breadth=pl.col("entry_name").str.slice(1, 2).cast(int),
+            depth=pl.col("entry_name").str.slice(4, 2).cast(int),
+        )
+        .drop("suite_name", "entry_name")
+    )
+
+
+def collect_all(lazy_frames):
+    """Collect lazy_frames in one go (sharing their common sub-plans), with the
+    streaming engine for large inputs"""
+
+    if os.path.getsize(INPUT) < STREAMING_MIN_BYTES:
+        return pl.collect_all(lazy_frames)
+    try:
+        return pl.collect_all(lazy_frames, engine="streaming")
+    except TypeError:
+        # Older Polars (such as 1.9)
+        return pl.collect_all(lazy_frames, streaming=True)
+
+
+frames = (
+    None
+    if incremental is None
+    else incremental.load_frames(FRAMES, params=[MAX_DURATION_MS])
 )
 
+if frames is None:
+    data = aggregate_replicates(raw_data)
+else:
+    # Only re-aggregate the groups that new rows were added to
+    new_replicates = new_data.select(REPLICATES).unique()
+    data = pl.concat(
+        [
+            frames["data"]
+            .lazy()
+            .join(new_replicates, on=REPLICATES, how="anti"),
+            aggregate_replicates(
+                raw_data.join(new_replicates, on=REPLICATES, how="semi")
+            ),
+        ]
+    )
+
+# Everything that reads the raw data is collected together (in one pass over
+# the input); everything else is computed from the much smaller data frame
+consistent, late, data = collect_all([consistent, late, data])
+
+if CHECK:
+    assert consistent.item()
+
+print(
+    "note:",
+    late.item(),
+    "entries completed after time cutoff of",
+    MAX_DURATION_MS // 1000,
+    "seconds",
+)
+
+if frames is None:
+    particulars = aggregate_particulars(data.lazy())
+else:
+    new_tasks = new_replicates.select(TASKS).unique()
+    particulars = pl.concat(
+        [
+            frames["particulars"].lazy().join(new_tasks, on=TASKS, how="anti"),
+            aggregate_particulars(
+                data.lazy().join(new_tasks, on=TASKS, how="semi")
+            ),
+        ]
+    )
+
 # Collect anys
-anys = data.filter(pl.col("solution_name") == ANY_TASK)
+anys = data.lazy().filter(pl.col("solution_name") == ANY_TASK)
+
+scal = scalability_columns(particulars)
 
 # Collect overall completion information (particular)
 particular_overall_completion = particulars.group_by(SUITES).agg(
@@ -115,37 +283,19 @@ any_overall_completion = anys.group_by(SUITES).agg(
     total=pl.col("completed").len(),
 )
 
-# Compute scalability-specific columns
-scal = (
-    particulars.filter(pl.col("suite_name") == "scal")
-    .with_columns(
-        breadth=pl.col("entry_name").str.slice(1, 2).cast(int),
-        depth=pl.col("entry_name").str.slice(4, 2).cast(int),
-    )
-    .drop("suite_name", "entry_name")
+# Join the algorithm metadata (once for all particular plots)
+particular_metadata = particulars.join(
+    algorithm_metadata,
+    how="left",
+    on="algorithm",
+    validate="m:1",
 )
 
-################################################################################
-# % % Plot data
-
-importlib.reload(lib)
-
-### Summary plots
-
-particular_summary = (
-    particulars.filter(pl.col("completed"))
-    .join(
-        particular_overall_completion,
-        how="left",
-        on=["suite_name", "algorithm"],
-        validate="m:1",
-    )
-    .join(
-        algorithm_metadata,
-        how="left",
-        on="algorithm",
-        validate="m:1",
-    )
+particular_summary = particular_metadata.filter(pl.col("completed")).join(
+    particular_overall_completion,
+    how="left",
+    on=["suite_name", "algorithm"],
+    validate="m:1",
 )
 
 any_summary = (
@@ -164,9 +314,80 @@ any_summary = (
     )
 )
 
+speedup_data = particular_metadata.filter(
+    (pl.col("algorithm") == "PBNHoneybee") & (pl.col("completed"))
+).join(
+    particular_metadata.filter(
+        (pl.col("algorithm") == "PBNHoneybeeNoMemo") & (pl.col("completed"))
+    ),
+    how="inner",
+    on=["suite_name", "entry_name"],
+    validate="1:1",
+)
+
+scal_summary = scalability_columns(
+    particular_metadata.filter(pl.col("completed"))
+)
+
+(
+    particulars,
+    anys,
+    scal,
+    particular_summary,
+    any_summary,
+    speedup_data,
+    scal_summary,
+) = pl.collect_all(
+    [
+        particulars,
+        anys,
+        scal,
+        particular_summary,
+        any_summary,
+        speedup_data,
+        scal_summary,
+    ]
+)
+
+if incremental is not None:
+    incremental.save_frames(
+        {
+            "data": data,
+            "particulars": particulars,
+        },
+        params=[MAX_DURATION_MS],
+    )
+
+
+# Figures to render, as (filename, plot function, data, plot keyword arguments,
+# save keyword arguments)
+figures = []
+
+
+def figure(name, plot, df, *, save_kwargs=None, **kwargs):
+    """Queue the figure called name, rendered as plot(df, **kwargs), if it was
+    requested (in incremental mode, only if its data changed since it was last
+    rendered)"""
+
+    if name not in RENDER:
+        return
+    filename = f"{OUTPUT_DIR}/{FIGURES.index(name) + 1:02d}-{name}.pdf"
+    if incremental is None or incremental.stale(filename, df):
+        figures.append((filename, plot, df, kwargs, save_kwargs or {}))
+
+
+################################################################################
+# % % Plot data
+
+importlib.reload(lib)
+
+### Summary plots
 
-def summary_plot(df, *, bins, **kwargs):
-    return lib.distributions(
+
+def summary_plot(name, df, *, bins, **kwargs):
+    figure(
+        name,
+        lib.distributions,
         df,
         check=CHECK,
         group_feature="algorithm",
@@ -186,7 +407,8 @@ def summary_plot(df, *, bins, **kwargs):
 
 # Fin
 
-fig, ax = summary_plot(
+summary_plot(
+    "fin",
     particular_summary.filter(
         (pl.col("suite_name") == "fin") & pl.col("algorithm_main"),
     ),
@@ -194,11 +416,10 @@ fig, ax = summary_plot(
     stretch=5,
 )
 
-fig.save(f"{OUTPUT_DIR}/01-fin.pdf")
-
 # Inf
 
-fig, ax = summary_plot(
+summary_plot(
+    "inf",
     particular_summary.filter(
         (pl.col("suite_name") == "inf")
         & (pl.col("algorithm") == "PBNHoneybee"),
@@ -207,11 +428,10 @@ fig, ax = summary_plot(
     stretch=5,
 )
 
-fig.save(f"{OUTPUT_DIR}/02-inf.pdf")
-
 # Any
 
-fig, ax = summary_plot(
+summary_plot(
+    "any",
     any_summary.filter(
         (pl.col("suite_name").is_in(["fin", "inf"])) & pl.col("algorithm_main"),
     ),
@@ -219,11 +439,10 @@ fig, ax = summary_plot(
     stretch=5,
 )
 
-fig.save(f"{OUTPUT_DIR}/05-any.pdf")
+# Naive oracle, Fin (appendix plot)
 
-# Naive oracle, Fin
-
-fig, ax = summary_plot(
+summary_plot(
+    "naive-fin",
     particular_summary.filter(
         (pl.col("suite_name") == "fin")
         & (pl.col("algorithm") == "PBNConstructiveOracle"),
@@ -232,12 +451,10 @@ fig, ax = summary_plot(
     stretch=5,
 )
 
-# Appendix plot
-fig.save(f"{OUTPUT_DIR}/06-naive-fin.pdf")
-
-# Naive oracle, Inf
+# Naive oracle, Inf (appendix plot)
 
-fig, ax = summary_plot(
+summary_plot(
+    "naive-inf",
     particular_summary.filter(
         (pl.col("suite_name") == "inf")
         & (pl.col("algorithm") == "PBNConstructiveOracle"),
@@ -246,31 +463,12 @@ fig, ax = summary_plot(
     stretch=5,
 )
 
-# Appendix plot
-fig.save(f"{OUTPUT_DIR}/07-naive-inf.pdf")
-
 ### Speedup plot
 
-df = particulars.join(
-    algorithm_metadata,
-    how="left",
-    on="algorithm",
-    validate="m:1",
-)
-
-df = df.filter(
-    (pl.col("algorithm") == "PBNHoneybee") & (pl.col("completed"))
-).join(
-    df.filter(
-        (pl.col("algorithm") == "PBNHoneybeeNoMemo") & (pl.col("completed"))
-    ),
-    how="inner",
-    on=["suite_name", "entry_name"],
-    validate="1:1",
-)
-
-fig, ax = lib.speedup(
-    df,
+figure(
+    "speedup",
+    lib.speedup,
+    speedup_data,
     left_value_feature="duration",
     left_color_feature="algorithm_color",
     left_name="Honeybee (Full)",
@@ -282,48 +480,53 @@ fig, ax = lib.speedup(
     padding=0.1,
 )
 
-fig.save(f"{OUTPUT_DIR}/04-speedup.pdf")
-
 ### Scalability
 
-fig, ax = lib.scalability(
-    scal.filter(pl.col("completed"))
-    .join(algorithm_metadata, how="left", on="algorithm", validate="m:1")
-    .filter(pl.col("algorithm_main")),
-    check=CHECK,
-    max_breadth=MAX_BREADTH,
-    max_depth=MAX_DEPTH,
-    const_breadth=CONST_BREADTH,
-    const_depth=CONST_DEPTH,
-    group_feature="algorithm",
-    sort_feature="algorithm_order",
-    name_feature="algorithm_name",
-    value_feature="duration",
-    color_feature="algorithm_color",
-    marker_feature="algorithm_marker",
-    depth_feature="depth",
-    breadth_feature="breadth",
+
+def scalability_plot(name, df):
+    figure(
+        name,
+        lib.scalability,
+        df,
+        save_kwargs={"bbox_inches": "tight"},
+        check=CHECK,
+        max_breadth=MAX_BREADTH,
+        max_depth=MAX_DEPTH,
+        const_breadth=CONST_BREADTH,
+        const_depth=CONST_DEPTH,
+        group_feature="algorithm",
+        sort_feature="algorithm_order",
+        name_feature="algorithm_name",
+        value_feature="duration",
+        color_feature="algorithm_color",
+        marker_feature="algorithm_marker",
+        depth_feature="depth",
+        breadth_feature="breadth",
+    )
+
+
+scalability_plot(
+    "scalability",
+    scal_summary.filter(pl.col("algorithm_main")),
 )
 
-fig.save(f"{OUTPUT_DIR}/03-scalability.pdf", bbox_inches="tight")
-
-fig, ax = lib.scalability(
-    scal.filter(pl.col("completed"))
-    .join(algorithm_metadata, how="left", on="algorithm", validate="m:1")
-    .filter(pl.col("algorithm") == "PBNConstructiveOracle"),
-    check=CHECK,
-    max_breadth=MAX_BREADTH,
-    max_depth=MAX_DEPTH,
-    const_breadth=CONST_BREADTH,
-    const_depth=CONST_DEPTH,
-    group_feature="algorithm",
-    sort_feature="algorithm_order",
-    name_feature="algorithm_name",
-    value_feature="duration",
-    color_feature="algorithm_color",
-    marker_feature="algorithm_marker",
-    depth_feature="depth",
-    breadth_feature="breadth",
+scalability_plot(
+    "naive-scalability",
+    scal_summary.filter(pl.col("algorithm") == "PBNConstructiveOracle"),
 )
 
-fig.save(f"{OUTPUT_DIR}/08-naive-scalability.pdf", bbox_inches="tight")
+################################################################################
+# % % Render figures
+
+if render_pool is None:
+    for spec in figures:
+        lib.render_figure(*spec)
+else:
+    with render_pool:
+        for future in [
+            render_pool.submit(lib.render_figure, *spec) for spec in figures
+        ]:
+            future.result()
+
+if incremental is not None:
+    incremental.commit()
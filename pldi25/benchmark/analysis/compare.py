@@ -0,0 +1,343 @@
+import argparse
+
+parser = argparse.ArgumentParser(
+    description="Compare two benchmark results (such as from two engine builds)"
+    " and report the entries that got significantly slower; exits with status"
+    " 1 if any did"
+)
+parser.add_argument("baseline", metavar="BASELINE_TSV")
+parser.add_argument("candidate", metavar="CANDIDATE_TSV")
+parser.add_argument("output_dir", metavar="OUTPUT_DIR")
+parser.add_argument(
+    "--max-duration",
+    type=int,
+    metavar="SECONDS",
+    help="count runs that took longer than this as not completed",
+)
+parser.add_argument(
+    "--confidence",
+    type=float,
+    default=0.95,
+    help="confidence level of the bootstrap intervals (default: %(default)s)",
+)
+parser.add_argument(
+    "--min-slowdown",
+    type=float,
+    default=0.05,
+    help="only flag entries whose median is confidently at least this much"
+    " (relatively) slower (default: %(default)s)",
+)
+parser.add_argument(
+    "--resamples",
+    type=int,
+    default=10_000,
+    help="number of bootstrap resamples (default: %(default)s)",
+)
+parser.add_argument(
+    "--seed",
+    type=int,
+    default=0,
+    help="seed of the bootstrap resampling (default: %(default)s)",
+)
+args = parser.parse_args()
+
+################################################################################
+# % % Imports
+
+import json
+import os
+import sys
+
+import numpy as np
+import polars as pl
+
+################################################################################
+# % % Config
+
+# Key for sets of runs on same task with same particular solution (replicates)
+REPLICATES = ["suite_name", "algorithm", "entry_name", "solution_name"]
+
+# Durations are measured in whole milliseconds, so medians below this are
+# treated as this when comparing them (in seconds)
+RESOLUTION = 0.001
+
+# The most bootstrap samples to draw at once (bounds the memory used)
+MAX_DRAWS = 1 << 23
+
+# The order to report statuses in (the first two are regressions)
+STATUSES = [
+    "regression",
+    "newly failing",
+    "improvement",
+    "newly completing",
+    "unchanged",
+    "failing",
+    "removed",
+    "added",
+]
+
+################################################################################
+# % % Load
+
+
+def load(path):
+    """The durations (in seconds) of each set of replicates in the benchmark
+    TSV at path, and whether they all completed"""
+
+    completed = pl.col("completed")
+    if args.max_duration is not None:
+        completed = completed & (pl.col("duration") <= args.max_duration * 1000)
+
+    return (
+        # The types would be inferred as String from a header-only TSV (of a
+        # benchmark that has just started)
+        pl.read_csv(
+            path,
+            separator="\t",
+            schema_overrides={"duration": pl.Int64, "completed": pl.Boolean},
+        )
+        .group_by(REPLICATES)
+        .agg(
+            completed=completed.all(),
+            durations=pl.col("duration") / 1000,
+        )
+    )
+
+
+baseline = load(args.baseline)
+candidate = load(args.candidate)
+
+data = baseline.join(
+    candidate,
+    on=REPLICATES,
+    how="full",
+    coalesce=True,
+    suffix="_candidate",
+).rename({"completed": "completed_baseline", "durations": "durations_baseline"})
+
+################################################################################
+# % % Bootstrap
+
+
+def bootstrap_medians(samples, rng):
+    """The bootstrap distribution of the median of each sample (one row of
+    args.resamples medians per sample)
+
+    Samples with the same number of values are resampled together, as one
+    array of indices per batch."""
+
+    sizes = np.array([len(s) for s in samples], dtype=np.int64)
+    medians = np.empty((len(samples), args.resamples))
+    for n in np.unique(sizes):
+        which = np.flatnonzero(sizes == n)
+        values = np.stack([samples[i] for i in which])
+        batch = max(1, MAX_DRAWS // (args.resamples * n))
+        for start in range(0, len(which), batch):
+            vals = values[start : start + batch]
+            picks = rng.integers(0, n, size=(len(vals), args.resamples, n))
+            rows = np.arange(len(vals))[:, None, None]
+            medians[which[start : start + batch]] = np.median(
+                vals[rows, picks], axis=2
+            )
+    return medians
+
+
+def interval(distribution):
+    """The percentile bootstrap confidence interval of each row"""
+
+    alpha = 1 - args.confidence
+    return np.quantile(distribution, [alpha / 2, 1 - alpha / 2], axis=1)
+
+
+rng = np.random.default_rng(args.seed)
+
+# Sorted so that the same seed gives the same resamples (group_by and join do
+# not keep row order)
+both = data.filter(
+    pl.col("completed_baseline") & pl.col("completed_candidate")
+).sort(REPLICATES)
+
+base = [d.to_numpy() for d in both["durations_baseline"]]
+cand = [d.to_numpy() for d in both["durations_candidate"]]
+
+base_boot = bootstrap_medians(base, rng)
+cand_boot = bootstrap_medians(cand, rng)
+
+base_low, base_high = interval(base_boot)
+cand_low, cand_high = interval(cand_boot)
+ratio_low, ratio_high = interval(
+    np.maximum(cand_boot, RESOLUTION) / np.maximum(base_boot, RESOLUTION)
+)
+
+stats = pl.DataFrame(
+    {
+        "baseline_low": base_low,
+        "baseline_high": base_high,
+        "candidate_low": cand_low,
+        "candidate_high": cand_high,
+        "ratio_low": ratio_low,
+        "ratio_high": ratio_high,
+    }
+)
+
+################################################################################
+# % % Classify
+
+slower = 1 + args.min_slowdown
+
+results = (
+    data.join(
+        pl.concat([both.select(REPLICATES), stats], how="horizontal"),
+        on=REPLICATES,
+        how="left",
+    )
+    .with_columns(
+        baseline_replicates=pl.col("durations_baseline").list.len(),
+        baseline_median=pl.col("durations_baseline").list.median(),
+        candidate_replicates=pl.col("durations_candidate").list.len(),
+        candidate_median=pl.col("durations_candidate").list.median(),
+    )
+    .with_columns(
+        ratio=pl.max_horizontal("candidate_median", pl.lit(RESOLUTION))
+        / pl.max_horizontal("baseline_median", pl.lit(RESOLUTION)),
+        status=pl.when(pl.col("completed_candidate").is_null())
+        .then(pl.lit("removed"))
+        .when(pl.col("completed_baseline").is_null())
+        .then(pl.lit("added"))
+        .when(~pl.col("completed_baseline") & ~pl.col("completed_candidate"))
+        .then(pl.lit("failing"))
+        .when(~pl.col("completed_candidate"))
+        .then(pl.lit("newly failing"))
+        .when(~pl.col("completed_baseline"))
+        .then(pl.lit("newly completing"))
+        .when(pl.col("ratio_low") > slower)
+        .then(pl.lit("regression"))
+        .when(pl.col("ratio_high") < 1 / slower)
+        .then(pl.lit("improvement"))
+        .otherwise(pl.lit("unchanged")),
+    )
+    .drop("durations_baseline", "durations_candidate")
+    .sort(
+        pl.col("status").replace_strict(STATUSES, range(len(STATUSES))),
+        pl.col("ratio"),
+        *REPLICATES,
+        descending=[False, True] + [False] * len(REPLICATES),
+        nulls_last=True,
+    )
+)
+
+counts = dict(
+    results.group_by("status").len().select("status", "len").iter_rows()
+)
+summary = {status: counts.get(status, 0) for status in STATUSES}
+
+################################################################################
+# % % Report
+
+os.makedirs(args.output_dir, exist_ok=True)
+
+with open(f"{args.output_dir}/comparison.json", "w") as f:
+    json.dump(
+        {
+            "baseline": args.baseline,
+            "candidate": args.candidate,
+            "max_duration": args.max_duration,
+            "confidence": args.confidence,
+            "min_slowdown": args.min_slowdown,
+            "resamples": args.resamples,
+            "seed": args.seed,
+            "summary": summary,
+            "entries": results.to_dicts(),
+        },
+        f,
+        indent=2,
+    )
+
+
+def seconds(x):
+    return "-" if x is None else f"{x:.3f}"
+
+
+def table(df, columns):
+    """A Markdown table of df, with columns given as (header, function from a
+    row to its cell)"""
+
+    lines = [
+        "| " + " | ".join(header for header, _ in columns) + " |",
+        "|" + "---|" * len(columns),
+    ]
+    for row in df.iter_rows(named=True):
+        lines.append("| " + " | ".join(cell(row) for _, cell in columns) + " |")
+    return "\n".join(lines)
+
+
+KEY_COLUMNS = [(key, lambda row, key=key: row[key]) for key in REPLICATES]
+
+MEDIAN_COLUMNS = [
+    (
+        "Baseline median (s)",
+        lambda row: (
+            f"{seconds(row['baseline_median'])} "
+            f"[{seconds(row['baseline_low'])}, {seconds(row['baseline_high'])}]"
+        ),
+    ),
+    (
+        "Candidate median (s)",
+        lambda row: (
+            f"{seconds(row['candidate_median'])} "
+            f"[{seconds(row['candidate_low'])}, {seconds(row['candidate_high'])}]"
+        ),
+    ),
+    (
+        "Ratio",
+        lambda row: (
+            f"{row['ratio']:.2f}x "
+            f"[{row['ratio_low']:.2f}, {row['ratio_high']:.2f}]"
+        ),
+    ),
+]
+
+lines = [
+    "# Benchmark comparison",
+    "",
+    f"- Baseline: `{args.baseline}`",
+    f"- Candidate: `{args.candidate}`",
+    (
+        f"- Medians with {args.confidence:.0%} bootstrap confidence intervals"
+        f" ({args.resamples} resamples); regressions are confidently at least"
+        f" {args.min_slowdown:.0%} slower"
+    ),
+    "",
+    table(
+        pl.DataFrame({"status": STATUSES, "count": list(summary.values())}),
+        [
+            ("Status", lambda row: row["status"]),
+            ("Entries", lambda row: str(row["count"])),
+        ],
+    ),
+]
+
+for status, title, columns in [
+    ("regression", "Regressions", MEDIAN_COLUMNS),
+    (
+        "newly failing",
+        "Newly failing",
+        [("Baseline median (s)", lambda row: seconds(row["baseline_median"]))],
+    ),
+    ("improvement", "Improvements", MEDIAN_COLUMNS),
+]:
+    df = results.filter(pl.col("status") == status)
+    if len(df) > 0:
+        lines += ["", f"## {title}", "", table(df, KEY_COLUMNS + columns)]
+
+with open(f"{args.output_dir}/comparison.md", "w") as f:
+    f.write("\n".join(lines) + "\n")
+
+regressions = summary["regression"] + summary["newly failing"]
+print(
+    f"{regressions} regressions ({summary['regression']} slower,"
+    f" {summary['newly failing']} newly failing),"
+    f" {summary['improvement']} improvements"
+)
+if regressions > 0:
+    sys.exit(1)
@@ -34,6 +34,13 @@ def save(self, filename, *args, **kwargs):
 matplotlib.figure.Figure.save = save
 
 
+def render_figure(filename, plot, df, kwargs, save_kwargs):
+    """Render plot(df, **kwargs) to filename (possibly in a worker process)"""
+
+    fig, _ = plot(df, **kwargs)
+    fig.save(filename, **save_kwargs)
+
+
 def show(df, sort_by=["algorithm"]):
     with pl.Config(tbl_cols=-1, tbl_rows=-1):
         print(df.sort(by=sort_by))
@@ -61,16 +68,42 @@ def distributions(
     if check and (xticklabels is not None):
         assert len(xticklabels) == len(bins)
 
-    groups = list(
-        df.sort(sort_feature).group_by(
-            group_feature,
-            maintain_order=True,
+    # Everything needed from each group in one aggregation (the count and
+    # total of each group are summed over the distinct values of
+    # count_total_agg_feature)
+    groups = (
+        df.sort(sort_feature)
+        .group_by(group_feature, maintain_order=True)
+        .agg(
+            name=pl.col(name_feature).first(),
+            color=pl.col(color_feature).first(),
+            vals=pl.col(value_feature),
+            min=pl.col(value_feature).min(),
+            max=pl.col(value_feature).max(),
+            count=pl.col(count_feature)
+            .filter(pl.col(count_total_agg_feature).is_first_distinct())
+            .sum(),
+            total=pl.col(total_feature)
+            .filter(pl.col(count_total_agg_feature).is_first_distinct())
+            .sum(),
         )
+        .drop(group_feature)
+        .rows(named=True)
     )
 
     if len(groups) == 0:
         return plt.subplots(1, 1)
 
+    if check:
+        for group in groups:
+            assert group["min"] >= min(bins), (group["name"], group["min"])
+            assert group["max"] <= max(bins), (group["name"], group["max"])
+
+    # The bin counts of each group (drawn as precomputed bars)
+    bins = np.asarray(bins)
+    vals = [np.asarray(group["vals"]) for group in groups]
+    counts = [np.histogram(v, bins=bins)[0] for v in vals]
+
     if flip:
         fig, ax = plt.subplots(
             1,
@@ -88,34 +121,33 @@ def distributions(
             sharex=True,
         )
 
-    max_bin_count = 0
-    for i, (_, group) in enumerate(groups):
-        name = group[name_feature][0]
-        vals = group[value_feature]
-        color = group[color_feature][0]
-
-        count_total_df = group.group_by(count_total_agg_feature).agg(
-            count=pl.col(count_feature).first(),
-            total=pl.col(total_feature).first(),
-        )
-
-        count = count_total_df["count"].sum()
-        total = count_total_df["total"].sum()
-
-        if check:
-            assert min(vals) >= min(bins), (name, min(vals))
-            assert max(vals) <= max(bins), (name, max(vals))
+    max_bin_count = max(n.max() for n in counts)
+    for i, group in enumerate(groups):
+        name = group["name"]
+        color = group["color"]
+        count = group["count"]
+        total = group["total"]
 
         axa = ax[3 * i + 1] if flip else ax[3 * i]
 
-        n, _, _ = axa.hist(
-            vals,
-            bins=bins,
-            color=color,
-            edgecolor="black",
-            orientation="horizontal" if flip else "vertical",
-        )
-        max_bin_count = max(max_bin_count, max(n))
+        if flip:
+            axa.barh(
+                bins[:-1],
+                counts[i],
+                height=np.diff(bins),
+                align="edge",
+                color=color,
+                edgecolor="black",
+            )
+        else:
+            axa.bar(
+                bins[:-1],
+                counts[i],
+                width=np.diff(bins),
+                align="edge",
+                color=color,
+                edgecolor="black",
+            )
 
         if flip:
             axa.set_yticks(bins, labels=bins, family=SERIF_FONT)
@@ -155,7 +187,7 @@ def distributions(
         axb = ax[3 * i] if flip else ax[3 * i + 1]
 
         axb.boxplot(
-            vals,
+            vals[i],
             vert=flip,
             widths=0.5,
             patch_artist=True,
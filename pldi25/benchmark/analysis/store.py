@@ -0,0 +1,202 @@
+import hashlib
+import io
+import json
+import os
+
+import numpy as np
+import polars as pl
+
+STATE = "state.json"
+
+# The size of the blocks the input is hashed and searched in
+BLOCK_SIZE = 1 << 20
+
+
+def hash_prefix(f, h, size):
+    """Update h with the first size bytes of f, one block at a time"""
+
+    f.seek(0)
+    while size > 0:
+        block = f.read(min(BLOCK_SIZE, size))
+        if not block:
+            break
+        h.update(block)
+        size -= len(block)
+
+
+def complete_end(f, size):
+    """The offset just after the last newline in the first size bytes of f
+    (0 if there is none), searching backwards one block at a time"""
+
+    pos = size
+    while pos > 0:
+        n = min(BLOCK_SIZE, pos)
+        f.seek(pos - n)
+        i = f.read(n).rfind(b"\n")
+        if i >= 0:
+            return pos - n + i + 1
+        pos -= n
+    return 0
+
+
+def fingerprint(frames, extra=()):
+    """Hash of the contents of frames (independent of row order)"""
+
+    h = hashlib.sha256()
+    for df in frames:
+        h.update(repr(df.schema).encode("utf-8"))
+        h.update(np.sort(df.hash_rows(seed=0).to_numpy()).tobytes())
+    for x in extra:
+        h.update(repr(x).encode("utf-8"))
+    return h.hexdigest()
+
+
+class Store:
+    """Incremental store of benchmark results, their aggregated frames, and the
+    data behind each figure
+
+    Benchmark TSVs are ingested append-only: if the input starts with the rows
+    ingested so far, only the rows after them are parsed (and saved as a new
+    Parquet chunk); otherwise, the store starts over. Aggregated frames are
+    saved keyed by a hash of the input they were computed from, and each
+    figure's fingerprint (of its input frames and the analysis code) is
+    recorded so that figures whose data has not changed are not re-rendered."""
+
+    def __init__(self, directory, *, code):
+        self.directory = directory
+        os.makedirs(f"{directory}/raw", exist_ok=True)
+        os.makedirs(f"{directory}/frames", exist_ok=True)
+
+        try:
+            with open(f"{directory}/{STATE}", "r") as f:
+                self.state = json.load(f)
+        except FileNotFoundError:
+            self.state = {"input": None, "frames": None, "figures": {}}
+
+        code_hash = hashlib.sha256()
+        for path in code:
+            with open(path, "rb") as f:
+                code_hash.update(f.read())
+        self.code = code_hash.hexdigest()
+
+        # The input hash that the rows before the new ones correspond to
+        self.base = None
+
+        # Fingerprints of figures rendered in this run (recorded on commit)
+        self.rendered = {}
+
+    def _save_state(self):
+        tmp = f"{self.directory}/{STATE}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp, f"{self.directory}/{STATE}")
+
+    def ingest(self, path):
+        """Ingest the TSV at path, returning (lazily) all of its rows and the
+        rows that were not ingested before"""
+
+        with open(path, "rb") as f:
+            header = f.readline()
+            if not header.endswith(b"\n"):
+                header = b""
+
+            # Only ingest complete lines (the benchmark may still be writing)
+            end = complete_end(f, os.fstat(f.fileno()).st_size)
+
+            # Hash of the input up to start (to be extended with the new rows)
+            h = hashlib.sha256()
+
+            ingested = self.state["input"]
+            if ingested is not None and ingested["bytes"] <= end:
+                hash_prefix(f, h, ingested["bytes"])
+            if ingested is not None and h.hexdigest() == ingested["sha256"]:
+                self.base = ingested["sha256"]
+                start = ingested["bytes"]
+                chunks = ingested["chunks"]
+                # Infer the schema if no rows were ingested (only the header)
+                schema = (
+                    pl.read_parquet_schema(f"{self.directory}/raw/{chunks[0]}")
+                    if chunks
+                    else None
+                )
+            else:
+                if ingested is not None:
+                    self.state["input"] = None
+                    self._save_state()
+                    for chunk in ingested["chunks"]:
+                        os.remove(f"{self.directory}/raw/{chunk}")
+                h = hashlib.sha256(header)
+                start = len(header)
+                chunks = []
+                schema = None
+
+            f.seek(start)
+            tail = f.read(end - start)
+            h.update(tail)
+
+        new = pl.read_csv(
+            io.BytesIO(header + tail),
+            separator="\t",
+            schema=schema,
+        )
+
+        if len(new) > 0:
+            chunk = f"{start:012d}-{end:012d}.parquet"
+            new.write_parquet(f"{self.directory}/raw/{chunk}")
+            chunks = chunks + [chunk]
+
+        self.state["input"] = {
+            "bytes": end,
+            "sha256": h.hexdigest(),
+            "chunks": chunks,
+        }
+        self._save_state()
+
+        if not chunks:
+            return new.lazy(), new.lazy()
+
+        raw = pl.scan_parquet(
+            [f"{self.directory}/raw/{chunk}" for chunk in chunks]
+        )
+        return raw, new.lazy()
+
+    def load_frames(self, names, *, params):
+        """The saved frames computed from the rows before the new ones (with
+        the same params), or None if there are none"""
+
+        key = {"input": self.base, "params": params}
+        if self.base is None or self.state["frames"] != key:
+            return None
+
+        return {
+            name: pl.read_parquet(f"{self.directory}/frames/{name}.parquet")
+            for name in names
+        }
+
+    def save_frames(self, frames, *, params):
+        """Save frames computed from all the ingested rows (with params)"""
+
+        for name, df in frames.items():
+            df.write_parquet(f"{self.directory}/frames/{name}.parquet")
+        self.state["frames"] = {
+            "input": self.state["input"]["sha256"],
+            "params": params,
+        }
+        self._save_state()
+
+    def stale(self, filename, *frames):
+        """Whether filename needs to be (re-)rendered from frames"""
+
+        key = os.path.abspath(filename)
+        fp = fingerprint(frames, extra=[self.code])
+        if self.state["figures"].get(key) == fp and os.path.exists(filename):
+            return False
+        self.rendered[key] = fp
+        return True
+
+    def commit(self):
+        """Record the figures rendered in this run"""
+
+        self.state["figures"].update(self.rendered)
+        self.rendered = {}
+        self._save_state()
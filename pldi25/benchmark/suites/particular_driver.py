@@ -1,16 +1,22 @@
+import argparse
 import asyncio
 import glob
+import hashlib
+import json
 import os
 import random
 import shutil
 import sys
 
 OPTION_COUNT = "option count: "
+DONE = "done: "
+NOT_POSSIBLE = "not possible: "
 LIB_EXT = ".hblib.toml"
 PROG_EXT = ".hb.toml"
+HONEYBEE = "target/debug/honeybee"
 
 
-async def run_one(hblib, prog, json):
+async def run_one(hblib, prog, json_path):
     hb = await asyncio.create_subprocess_shell(
         " ".join(
             [
@@ -25,7 +31,7 @@ async def run_one(hblib, prog, json):
                 "-p",
                 prog,
                 "-j",
-                json,
+                json_path,
             ]
         ),
         stdin=asyncio.subprocess.PIPE,
@@ -45,15 +51,138 @@ async def run_one(hblib, prog, json):
         await hb.stdin.drain()
 
 
-async def run_all(suite, max_retries=30):
-    hblib = suite + "/_suite" + LIB_EXT
+class Navigator:
+    """A long-lived `interact --repeat` process for one program that runs
+    many random walks (without recompiling or reloading the problem)"""
 
-    progs = sorted(glob.glob(suite + "/*" + PROG_EXT))
+    def __init__(self, hb):
+        self.hb = hb
+
+    @classmethod
+    async def start(cls, hblib, prog):
+        hb = await asyncio.create_subprocess_exec(
+            HONEYBEE,
+            "interact",
+            "--quiet",
+            "--repeat",
+            "-l",
+            hblib,
+            "-p",
+            prog,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+        )
+        return cls(hb)
+
+    async def send(self, line):
+        self.hb.stdin.write((line + "\n").encode("utf-8"))
+        await self.hb.stdin.drain()
+
+    async def walk(self, json_path, choose):
+        """Take steps (chosen by choose from the option count) until the
+        program is complete, writing its solution to json_path
+
+        Returns whether a solution was reached; if the walk reached a dead end
+        instead, nothing is written to json_path."""
+
+        await self.send(json_path)
+        while True:
+            stdout = (await self.hb.stdout.readline()).decode()
+            if not stdout:
+                raise RuntimeError(f"interact exited during walk to '{json_path}'")
+            if stdout.startswith(OPTION_COUNT):
+                options = int(stdout[len(OPTION_COUNT) :])
+                await self.send(str(choose(options)))
+            elif stdout.startswith(DONE):
+                return True
+            elif stdout.startswith(NOT_POSSIBLE):
+                return False
+
+    async def close(self):
+        try:
+            await self.send("")
+        except ConnectionError:
+            pass  # Already exited (the error is reported by walk)
+        await self.hb.wait()
+
+
+class _Node:
+    __slots__ = ("options", "children", "explored")
+
+    def __init__(self):
+        self.options = None
+        self.children = {}
+        # Choices whose subtrees have been fully walked
+        self.explored = set()
+
+
+class ExploringSampler:
+    """Chooses random steps that avoid choice sequences already walked
 
+    Every walk is recorded in a trie of choice sequences. Once all the options
+    below a prefix have been walked, that prefix is marked explored and never
+    chosen again, so every walk takes a new choice sequence (until the whole
+    tree has been explored)."""
+
+    def __init__(self, rng):
+        self.rng = rng
+        self.root = _Node()
+        self.exhausted = False
+        self._node = self.root
+        self._path = []
+
+    def choose(self, options):
+        node = self._node
+        if node.options is None:
+            node.options = options
+        elif node.options != options:
+            raise RuntimeError(
+                f"option count changed from {node.options} to {options} "
+                "on the same choice sequence"
+            )
+        choice = self.rng.choice(
+            [c for c in range(1, options + 1) if c not in node.explored]
+        )
+        self._path.append((node, choice))
+        self._node = node.children.setdefault(choice, _Node())
+        return choice
+
+    def finish(self):
+        """Record that the current walk is complete"""
+
+        for node, choice in reversed(self._path):
+            node.explored.add(choice)
+            del node.children[choice]
+            if len(node.explored) < node.options:
+                break
+        else:
+            self.exhausted = True
+        self._node = self.root
+        self._path = []
+
+
+def solution_digest(path):
+    """Hash of the solution tree in path, independent of its key order"""
+
+    with open(path, "r") as f:
+        solution = json.load(f)
+    canonical = json.dumps(solution, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def reset(progs):
     for prog in progs:
         base = prog[: -len(PROG_EXT)]
         shutil.rmtree(base, ignore_errors=True)
 
+
+async def run_all(suite, max_retries=30):
+    hblib = suite + "/_suite" + LIB_EXT
+
+    progs = sorted(glob.glob(suite + "/*" + PROG_EXT))
+
+    reset(progs)
+
     for prog in progs:
         random.seed(0)
 
@@ -63,10 +192,10 @@ async def run_all(suite, max_retries=30):
         outputs = set()
         for sample in range(1, N + 1):
             print(f"{sample}, ", end="", flush=True)
-            json = f"{base}/sample{sample:05d}.json"
+            json_path = f"{base}/sample{sample:05d}.json"
             for _ in range(max_retries):
-                await run_one(hblib, prog, json)
-                with open(json, "r") as f:
+                await run_one(hblib, prog, json_path)
+                with open(json_path, "r") as f:
                     output = f.read()
                 if output in outputs:
                     print("retry, ", end="", flush=True)
@@ -75,20 +204,157 @@ async def run_all(suite, max_retries=30):
                     break
             else:
                 print("failed, ", end="")
-                os.remove(json)
+                os.remove(json_path)
         print("done!")
 
 
-if len(sys.argv) != 3:
-    print(
-        f"usage: python3 {sys.argv[0]} SUITE_NAME N_SAMPLES",
-        file=sys.stderr,
+async def run_entry(hblib, prog, semaphore, max_retries):
+    async with semaphore:
+        # Same seed (and so the same walks) as run_all
+        rng = random.Random(0)
+
+        base = prog[: -len(PROG_EXT)]
+        os.makedirs(base)
+        outputs = set()
+        retries = 0
+        dead_ends = 0
+        failed = 0
+
+        navigator = await Navigator.start(hblib, prog)
+        try:
+            for sample in range(1, N + 1):
+                json_path = f"{base}/sample{sample:05d}.json"
+                for _ in range(max_retries):
+                    solved = await navigator.walk(
+                        json_path, lambda options: rng.randint(1, options)
+                    )
+                    if not solved:
+                        dead_ends += 1
+                        continue
+                    with open(json_path, "r") as f:
+                        output = f.read()
+                    if output in outputs:
+                        retries += 1
+                    else:
+                        outputs.add(output)
+                        break
+                else:
+                    failed += 1
+                    if os.path.exists(json_path):
+                        os.remove(json_path)
+        finally:
+            await navigator.close()
+
+        print(
+            f"Done with '{prog}' ({retries} retries, {dead_ends} dead ends,"
+            f" {failed} failed)",
+            flush=True,
+        )
+
+
+async def explore_entry(hblib, prog, semaphore, max_retries):
+    async with semaphore:
+        sampler = ExploringSampler(random.Random(0))
+
+        base = prog[: -len(PROG_EXT)]
+        os.makedirs(base)
+        digests = set()
+        walks = 0
+        dead_ends = 0
+        failed = 0
+
+        navigator = await Navigator.start(hblib, prog)
+        try:
+            for sample in range(1, N + 1):
+                json_path = f"{base}/sample{sample:05d}.json"
+                found = False
+                for _ in range(max_retries):
+                    if sampler.exhausted:
+                        break
+                    solved = await navigator.walk(json_path, sampler.choose)
+                    sampler.finish()
+                    walks += 1
+                    if not solved:
+                        dead_ends += 1
+                        continue
+                    digest = solution_digest(json_path)
+                    if digest not in digests:
+                        digests.add(digest)
+                        found = True
+                        break
+                if found:
+                    continue
+                if os.path.exists(json_path):
+                    os.remove(json_path)
+                if sampler.exhausted:
+                    break
+                failed += 1
+        finally:
+            await navigator.close()
+
+        explored = ", all explored" if sampler.exhausted else ""
+        print(
+            f"Done with '{prog}' ({len(digests)} solutions in {walks} walks"
+            f"{explored}, {dead_ends} dead ends, {failed} failed)",
+            flush=True,
+        )
+
+
+async def run_all_pooled(suite, workers, explore, max_retries=30):
+    hblib = suite + "/_suite" + LIB_EXT
+
+    progs = sorted(glob.glob(suite + "/*" + PROG_EXT))
+
+    reset(progs)
+
+    build = await asyncio.create_subprocess_exec("cargo", "build", "-q")
+    if await build.wait() != 0:
+        sys.exit(1)
+
+    entry = explore_entry if explore else run_entry
+    semaphore = asyncio.Semaphore(workers)
+    # Let every entry finish (rather than cancelling the others on the first
+    # failure) and report the failures at the end
+    results = await asyncio.gather(
+        *(entry(hblib, prog, semaphore, max_retries) for prog in progs),
+        return_exceptions=True,
     )
-    sys.exit(1)
+    failures = [
+        (prog, result)
+        for prog, result in zip(progs, results)
+        if isinstance(result, Exception)
+    ]
+    for prog, error in failures:
+        print(f"Failed on '{prog}': {error}", file=sys.stderr)
+    if failures:
+        sys.exit(1)
+
+
+parser = argparse.ArgumentParser(
+    description="Generate particular solutions of a suite by random walks"
+)
+parser.add_argument("suite_name", metavar="SUITE_NAME")
+parser.add_argument("n_samples", metavar="N_SAMPLES", type=int)
+parser.add_argument(
+    "--workers",
+    type=int,
+    help="run this many entries at once, each with one long-lived interact "
+    "process (default: one cargo run per walk, one entry at a time)",
+)
+parser.add_argument(
+    "--explore",
+    action="store_true",
+    help="steer walks away from choice sequences already walked and detect "
+    "duplicate solutions by hash (implies --workers 1 if not given)",
+)
+args = parser.parse_args()
 
-suite_name = sys.argv[1]
-N = int(sys.argv[2])
+suite_name = args.suite_name
+N = args.n_samples
 
 os.chdir("../../backend/")
 suite = "../benchmark/suites/" + suite_name
-asyncio.run(run_all(suite))
+if args.workers is None and not args.explore:
+    asyncio.run(run_all(suite))
+else:
+    asyncio.run(run_all_pooled(suite, args.workers or 1, args.explore))
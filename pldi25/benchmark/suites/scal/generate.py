@@ -1,5 +1,23 @@
-import glob
+"""Generate a scalability suite
+
+By default, this (re)generates the `scal` suite in this directory: a linear
+chain of Step types (each taking the previous step and a Choice), varying the
+depth with the breadth held constant and vice versa. Other shapes, larger or
+full grids, and other output directories (each a separate suite, by default
+`../scal_SHAPE`) can be chosen with the options below.
+
+Every suite gets a `_manifest.csv` listing its entries (with their shape,
+depth, and breadth). Entry files that are unchanged are not rewritten. Entries
+of an earlier run that are no longer in the grid are kept (and regenerated
+along with it, so that they match the library) unless `--prune` is given, in
+which case they are removed (their particular solution directories are always
+kept)."""
+
+import argparse
+import concurrent.futures
+import csv
 import os
+import re
 
 # Constants
 
@@ -12,52 +30,427 @@ MIN_BREADTH = 1
 MAX_BREADTH = 10
 MAX_DEPTH = 10
 
+# The arity of internal nodes for the fanout shape
+ARITY = 2
+
+# The number of metadata fields for the metadata shape
+METADATA = 20
+
+MANIFEST = "_manifest.csv"
+
+ENTRY_PATTERN = re.compile(r"b([0-9]+)d([0-9]+)\.hb\.toml")
+
+# Shapes
+
+# Each shape is a library (of all depths up to a maximum) and the name of the
+# goal type for an entry of a given depth. The depth of an entry is the number
+# of non-Choice functions in each of its solutions (for the cycle shape, in its
+# shortest solutions).
+
+
+def chain_library(max_depth, width, options):
+    """Step{i} <- f{i}(s: Step{i-1}, choice: Choice)"""
+
+    lines = ['[Prop.In]\nparams.x = "Int"\n\n']
+    lines.append('[Type.Choice]\nparams.x = "Int"\n\n')
+
+    for depth in range(1, max_depth + 1):
+        lines.append(f"[Type.Step{depth:0{width}d}]\n")
+        lines.append("params = {}\n\n")
+
+    lines.append("[Function.choose]\n")
+    lines.append("params = {}\n")
+    lines.append('ret = "Choice"\n')
+    lines.append('condition = ["In { x = ret.x }"]\n\n')
+
+    lines.append(f"[Function.f{1:0{width}d}]\n")
+    lines.append('params.choice = "Choice"\n')
+    lines.append(f'ret = "Step{1:0{width}d}"\n')
+    lines.append("condition = []\n")
+
+    for depth in range(2, max_depth + 1):
+        lines.append(f"\n[Function.f{depth:0{width}d}]\n")
+        lines.append(f'params.s = "Step{depth - 1:0{width}d}"\n')
+        lines.append('params.choice = "Choice"\n')
+        lines.append(f'ret = "Step{depth:0{width}d}"\n')
+        lines.append("condition = []\n")
+
+    return "".join(lines)
+
+
+def fanout_library(max_depth, width, options):
+    """Node{i} <- n{i}(c1: Node{j1}, ..., cK: Node{jK}), where the children
+    split the other i - 1 nodes as evenly as possible (so the solution tree
+    has i nodes and logarithmic height); Node1 is a leaf taking a Choice"""
+
+    lines = ['[Prop.In]\nparams.x = "Int"\n\n']
+    lines.append('[Type.Choice]\nparams.x = "Int"\n\n')
+
+    for depth in range(1, max_depth + 1):
+        lines.append(f"[Type.Node{depth:0{width}d}]\n")
+        lines.append("params = {}\n\n")
+
+    lines.append("[Function.choose]\n")
+    lines.append("params = {}\n")
+    lines.append('ret = "Choice"\n')
+    lines.append('condition = ["In { x = ret.x }"]\n\n')
+
+    lines.append(f"[Function.n{1:0{width}d}]\n")
+    lines.append('params.choice = "Choice"\n')
+    lines.append(f'ret = "Node{1:0{width}d}"\n')
+    lines.append("condition = []\n")
+
+    for depth in range(2, max_depth + 1):
+        lines.append(f"\n[Function.n{depth:0{width}d}]\n")
+        rest = depth - 1
+        children = [
+            rest // options.arity + (k < rest % options.arity)
+            for k in range(options.arity)
+        ]
+        for k, child in enumerate(c for c in children if c > 0):
+            lines.append(f'params.c{k + 1} = "Node{child:0{width}d}"\n')
+        lines.append(f'ret = "Node{depth:0{width}d}"\n')
+        lines.append("condition = []\n")
+
+    return "".join(lines)
+
+
+def diamond_library(max_depth, width, options):
+    """Left{i} and Right{i} both take a Top{i-1} (and a Choice), and Top{i}
+    can be made from either of them, so each level is a diamond"""
+
+    lines = ['[Prop.In]\nparams.x = "Int"\n\n']
+    lines.append('[Type.Choice]\nparams.x = "Int"\n\n')
+
+    for depth in range(max_depth + 1):
+        lines.append(f"[Type.Top{depth:0{width}d}]\n")
+        lines.append("params = {}\n\n")
+        if depth == 0:
+            continue
+        for side in ["Left", "Right"]:
+            lines.append(f"[Type.{side}{depth:0{width}d}]\n")
+            lines.append("params = {}\n\n")
+
+    lines.append("[Function.choose]\n")
+    lines.append("params = {}\n")
+    lines.append('ret = "Choice"\n')
+    lines.append('condition = ["In { x = ret.x }"]\n\n')
+
+    lines.append("[Function.start]\n")
+    lines.append('params.choice = "Choice"\n')
+    lines.append(f'ret = "Top{0:0{width}d}"\n')
+    lines.append("condition = []\n")
+
+    for depth in range(1, max_depth + 1):
+        for side in ["Left", "Right"]:
+            lines.append(f"\n[Function.{side.lower()}{depth:0{width}d}]\n")
+            lines.append(f'params.s = "Top{depth - 1:0{width}d}"\n')
+            lines.append('params.choice = "Choice"\n')
+            lines.append(f'ret = "{side}{depth:0{width}d}"\n')
+            lines.append("condition = []\n")
+
+            lines.append(f"\n[Function.join_{side.lower()}{depth:0{width}d}]\n")
+            lines.append(f'params.s = "{side}{depth:0{width}d}"\n')
+            lines.append(f'ret = "Top{depth:0{width}d}"\n')
+            lines.append("condition = []\n")
+
+    return "".join(lines)
+
+
+def cycle_library(max_depth, width, options):
+    """A chain of Step{i} types in which every step can also wrap around to
+    Step1 (decreasing a count, as in the limited_cycle entry of the fin
+    suite); Done{i} is reached from Step{i}"""
+
+    lines = ['[Prop.In]\nparams.x = "Int"\n\n']
+    lines.append('[Type.Choice]\nparams.x = "Int"\n\n')
+
+    for depth in range(1, max_depth + 1):
+        lines.append(f"[Type.Step{depth:0{width}d}]\n")
+        lines.append('params.count = "Int"\n\n')
+        lines.append(f"[Type.Done{depth:0{width}d}]\n")
+        lines.append("params = {}\n\n")
+
+    lines.append("[Function.choose]\n")
+    lines.append("params = {}\n")
+    lines.append('ret = "Choice"\n')
+    lines.append('condition = ["In { x = ret.x }"]\n\n')
+
+    lines.append("[Function.start]\n")
+    lines.append('params.choice = "Choice"\n')
+    lines.append(f'ret = "Step{1:0{width}d}"\n')
+    lines.append('condition = ["ret.count = choice.x"]\n')
+
+    for depth in range(1, max_depth + 1):
+        if depth > 1:
+            lines.append(f"\n[Function.f{depth:0{width}d}]\n")
+            lines.append(f'params.s = "Step{depth - 1:0{width}d}"\n')
+            lines.append(f'ret = "Step{depth:0{width}d}"\n')
+            lines.append('condition = ["ret.count = s.count"]\n')
+
+        lines.append(f"\n[Function.wrap{depth:0{width}d}]\n")
+        lines.append(f'params.s = "Step{depth:0{width}d}"\n')
+        lines.append(f'ret = "Step{1:0{width}d}"\n')
+        lines.append("condition = [\n")
+        lines.append('    "ret.count < s.count",\n')
+        lines.append('    "0 < ret.count",\n')
+        lines.append("]\n")
+
+        lines.append(f"\n[Function.done{depth:0{width}d}]\n")
+        lines.append(f'params.s = "Step{depth:0{width}d}"\n')
+        lines.append(f'ret = "Done{depth:0{width}d}"\n')
+        lines.append("condition = []\n")
+
+    return "".join(lines)
+
+
+def metadata_library(max_depth, width, options):
+    """The chain shape, but with In props (and so Choice and every Step type)
+    carrying many metadata fields, each copied along by a condition"""
+
+    fields = [f"m{j:02d}" for j in range(1, options.metadata + 1)]
+
+    lines = ["[Prop.In]\n", 'params.x = "Int"\n']
+    lines.extend(f'params.{field} = "Str"\n' for field in fields)
+    lines.append("\n[Type.Choice]\n")
+    lines.append('params.x = "Int"\n')
+    lines.extend(f'params.{field} = "Str"\n' for field in fields)
+    lines.append("\n")
+
+    for depth in range(1, max_depth + 1):
+        lines.append(f"[Type.Step{depth:0{width}d}]\n")
+        lines.extend(f'params.{field} = "Str"\n' for field in fields)
+        lines.append("\n")
+        lines.append(f"[Type.Done{depth:0{width}d}]\n")
+        lines.append("params = {}\n\n")
+
+    lines.append("[Function.choose]\n")
+    lines.append("params = {}\n")
+    lines.append('ret = "Choice"\n')
+    lines.append('condition = ["""In {\n    x = ret.x')
+    lines.extend(f",\n    {field} = ret.{field}" for field in fields)
+    lines.append('\n}"""]\n')
+
+    copies = "".join(f'    "ret.{field} = choice.{field}",\n' for field in fields)
+
+    for depth in range(1, max_depth + 1):
+        lines.append(f"\n[Function.f{depth:0{width}d}]\n")
+        if depth > 1:
+            lines.append(f'params.s = "Step{depth - 1:0{width}d}"\n')
+        lines.append('params.choice = "Choice"\n')
+        lines.append(f'ret = "Step{depth:0{width}d}"\n')
+        lines.append(f"condition = [\n{copies}]\n")
+
+        lines.append(f"\n[Function.done{depth:0{width}d}]\n")
+        lines.append(f'params.s = "Step{depth:0{width}d}"\n')
+        lines.append(f'ret = "Done{depth:0{width}d}"\n')
+        lines.append("condition = []\n")
+
+    return "".join(lines)
+
+
+SHAPES = {
+    "chain": (chain_library, "Step"),
+    "fanout": (fanout_library, "Node"),
+    "diamond": (diamond_library, "Top"),
+    "cycle": (cycle_library, "Done"),
+    "metadata": (metadata_library, "Done"),
+}
+
 # Helpers
 
 
-def make_entry(depth, breadth):
-    with open(f"b{breadth:02d}d{depth:02d}.hb.toml", "w") as f:
-        for i in range(1, breadth + 1):
-            f.write("[[Prop]]\n")
-            f.write('name = "In"\n')
-            f.write(f"args.x = {i}\n\n")
-        f.write("[Goal]\n")
-        f.write(f'name = "Step{depth:02d}"\n')
-        f.write("args = {}")
+def entry_name(depth, breadth, width):
+    return f"b{breadth:0{width}d}d{depth:0{width}d}"
+
+
+def make_entry(task):
+    out_dir, shape, depth, breadth, width, metadata = task
+
+    lines = []
+    for i in range(1, breadth + 1):
+        lines.append("[[Prop]]\n")
+        lines.append('name = "In"\n')
+        lines.append(f"args.x = {i}\n")
+        if shape == "metadata":
+            lines.extend(f'args.m{j:02d} = "{i}.{j}"\n' for j in range(1, metadata + 1))
+        lines.append("\n")
+    lines.append("[Goal]\n")
+    lines.append(f'name = "{SHAPES[shape][1]}{depth:0{width}d}"\n')
+    lines.append("args = {}")
+
+    path = f"{out_dir}/{entry_name(depth, breadth, width)}.hb.toml"
+    write_if_changed(path, "".join(lines))
+
+
+def write_if_changed(path, contents):
+    """Write contents to path unless it already holds them (so that unchanged
+    entries keep their modification times)"""
+
+    try:
+        with open(path, "r") as f:
+            if f.read() == contents:
+                return
+    except FileNotFoundError:
+        pass
+    with open(path, "w") as f:
+        f.write(contents)
+
+
+def grid(args):
+    """The (depth, breadth) pairs to generate, in order and without
+    duplicates"""
+
+    depths = range(args.min_depth, args.max_depth + 1, args.stride)
+    breadths = range(args.min_breadth, args.max_breadth + 1, args.stride)
+
+    if args.grid == "full":
+        pairs = [(d, b) for d in depths for b in breadths]
+    else:
+        pairs = [(d, args.const_breadth) for d in depths]
+        pairs += [(args.const_depth, b) for b in breadths]
+
+    return list(dict.fromkeys(pairs))
+
+
+def existing_entries(out_dir):
+    """The entries already in out_dir, as (filename, depth, breadth, digits,
+    shape), where the shape is taken from the manifest (if it lists them)"""
+
+    shapes = {}
+    try:
+        with open(f"{out_dir}/{MANIFEST}", "r", newline="") as f:
+            for row in csv.DictReader(f):
+                shapes[row["entry_name"]] = row["shape"]
+    except FileNotFoundError:
+        pass
+
+    entries = []
+    for filename in sorted(os.listdir(out_dir)):
+        match = ENTRY_PATTERN.fullmatch(filename)
+        if match is None:
+            continue
+        breadth, depth = match.groups()
+        name = filename.removesuffix(".hb.toml")
+        entries.append(
+            (filename, int(depth), int(breadth), len(depth), shapes.get(name))
+        )
+    return entries
 
 
 # Main
 
-for filename in glob.glob("b[0-9][0-9]d[0-9][0-9].hb.toml"):
-    os.remove(filename)
 
-for depth in range(MIN_DEPTH, MAX_DEPTH + 1):
-    make_entry(depth, CONST_BREADTH)
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--shape", choices=SHAPES, default="chain")
+    parser.add_argument(
+        "--grid",
+        choices=["cross", "full"],
+        default="cross",
+        help="vary depth and breadth separately (holding the other constant) "
+        "or generate every combination",
+    )
+    parser.add_argument("--min-depth", type=int, default=MIN_DEPTH)
+    parser.add_argument("--max-depth", type=int, default=MAX_DEPTH)
+    parser.add_argument("--min-breadth", type=int, default=MIN_BREADTH)
+    parser.add_argument("--max-breadth", type=int, default=MAX_BREADTH)
+    parser.add_argument("--const-depth", type=int, default=CONST_DEPTH)
+    parser.add_argument("--const-breadth", type=int, default=CONST_BREADTH)
+    parser.add_argument(
+        "--stride",
+        type=int,
+        default=1,
+        help="step between generated depths and breadths",
+    )
+    parser.add_argument(
+        "--arity",
+        type=int,
+        default=ARITY,
+        help="children per node (fanout shape)",
+    )
+    parser.add_argument(
+        "--metadata",
+        type=int,
+        default=METADATA,
+        help="metadata fields per prop (metadata shape)",
+    )
+    parser.add_argument(
+        "--out-dir",
+        help="suite directory to write (default: this directory for the "
+        "chain shape, ../scal_SHAPE otherwise)",
+    )
+    parser.add_argument(
+        "--prune",
+        action="store_true",
+        help="remove entries of earlier runs that this run does not generate",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="number of processes writing entries",
+    )
+    args = parser.parse_args()
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    if args.out_dir is not None:
+        out_dir = args.out_dir
+    elif args.shape == "chain":
+        out_dir = here
+    else:
+        out_dir = f"{here}/../scal_{args.shape}"
+    os.makedirs(out_dir, exist_ok=True)
+
+    pairs = grid(args)
+    existing = existing_entries(out_dir)
+
+    # Entries kept from earlier runs share the library (and so its width)
+    sizes = [max(d, args.const_depth, b) for d, b in pairs]
+    if not args.prune:
+        sizes += [max(d, b) for _, d, b, _, _ in existing]
+    width = max(2, len(str(max(sizes))))
+
+    names = {entry_name(d, b, width) + ".hb.toml" for d, b in pairs}
+    stale = [entry for entry in existing if entry[0] not in names]
+    if args.prune:
+        for filename, *_ in stale:
+            os.remove(f"{out_dir}/{filename}")
+    else:
+        for filename, depth, breadth, digits, shape in stale:
+            if digits != width or shape not in [None, args.shape]:
+                parser.error(
+                    f"{filename} (from an earlier run) does not fit the "
+                    f"{args.shape} library of this run; pass --prune to "
+                    "remove it"
+                )
+            pairs.append((depth, breadth))
+
+    max_depth = max(max(d for d, _ in pairs), args.const_depth)
 
-for breadth in range(MIN_BREADTH, MAX_BREADTH + 1):
-    make_entry(CONST_DEPTH, breadth)
+    tasks = [(out_dir, args.shape, d, b, width, args.metadata) for d, b in pairs]
+    with concurrent.futures.ProcessPoolExecutor(args.jobs) as executor:
+        # Consume the results to raise any errors
+        for _ in executor.map(make_entry, tasks, chunksize=64):
+            pass
 
-with open("_suite.hblib.toml", "w") as f:
-    f.write('[Prop.In]\nparams.x = "Int"\n\n')
-    f.write('[Type.Choice]\nparams.x = "Int"\n\n')
+    library = SHAPES[args.shape][0]
+    write_if_changed(f"{out_dir}/_suite.hblib.toml", library(max_depth, width, args))
 
-    for depth in range(1, MAX_DEPTH + 1):
-        f.write(f"[Type.Step{depth:02d}]\n")
-        f.write("params = {}\n\n")
+    with open(f"{out_dir}/{MANIFEST}", "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["entry_name", "shape", "depth", "breadth"])
+        for d, b in pairs:
+            writer.writerow([entry_name(d, b, width), args.shape, d, b])
 
-    f.write("[Function.choose]\n")
-    f.write("params = {}\n")
-    f.write('ret = "Choice"\n')
-    f.write('condition = ["In { x = ret.x }"]\n\n')
+    kept = ""
+    if stale and not args.prune:
+        kept = f" ({len(stale)} kept from earlier runs)"
+    print(f"Wrote {len(pairs)} entries{kept} to {os.path.normpath(out_dir)}")
 
-    f.write("[Function.f01]\n")
-    f.write('params.choice = "Choice"\n')
-    f.write('ret = "Step01"\n')
-    f.write("condition = []\n")
 
-    for depth in range(2, MAX_DEPTH + 1):
-        f.write(f"\n[Function.f{depth:02d}]\n")
-        f.write(f'params.s = "Step{depth - 1:02d}"\n')
-        f.write('params.choice = "Choice"\n')
-        f.write(f'ret = "Step{depth:02d}"\n')
-        f.write("condition = []\n")
+if __name__ == "__main__":
+    main()